@@ -1,6 +1,5 @@
 import os
 import sys
-import time
 import pathlib 
 import argparse
 
@@ -9,6 +8,11 @@ from datetime import datetime
 from tomolog_cli import log
 from tomolog_cli import utils
 from tomolog_cli import config
+from tomolog_cli import cloud
+from tomolog_cli import bench
+from tomolog_cli import metrics
+from tomolog_cli import pipeline
+from tomolog_cli import standin
 from tomolog_cli import TomoLog
 from tomolog_cli import TomoLog32ID
 from tomolog_cli import TomoLog2BM
@@ -26,21 +30,52 @@ def run_status(args):
     config.log_values(args)
 
 
+def tomolog(args):
+    if args.beamline == '32-id':
+        return TomoLog32ID(args)
+    elif args.beamline == '2-bm':
+        return TomoLog2BM(args)
+    elif args.beamline == '7-bm':
+        return TomoLog7BM(args)
+    else:
+        return TomoLog(args)
+
+
 def run_log(args):
 
     log.warning('Publication start')
     log.warning('Slide formatting for beamline: %s', args.beamline)
+    if args.profile:
+        # the stages of the --batch threads run concurrently, their memory peaks would mix
+        if args.batch:
+            log.warning('Memory peaks of the stages are not traced with --batch')
+        metrics.start_profile(os.path.join(args.logs_home, 'tomolog_profile_' +
+                              datetime.strftime(datetime.now(), "%Y-%m-%d_%H_%M_%S")), memory=not args.batch)
+    # remove expired hosted images while publishing
+    cleanup = cloud.cleanup(args)
+    # the time spent outside of the publication stages of the data sets
+    with metrics.stage('run'):
+        publish(args)
+
+    cleanup.join()
+    # args.count = args.count + 1
+    if args.standin or args.dry_run:
+        # keep the presentation url, count and contrast of the real slides
+        log.info('Slides not published on google, %s not updated' % args.config)
+    else:
+        config.write(args.config, args, sections=config.PARAMS)
+    log.warning('publication end')
+    log.info('presentation-url: %s' % args.presentation_url)
+    metrics.report()
+    if args.standin:
+        standin.report()
+
+
+def publish(args):
     file_path = pathlib.Path(args.file_name)
     if file_path.is_file():
         log.info("publishing a single file: %s" % args.file_name)
-        if args.beamline == '32-id':
-            TomoLog32ID(args).run_log()
-        elif args.beamline == '2-bm':
-            TomoLog2BM(args).run_log()
-        elif args.beamline == '7-bm':
-            TomoLog7BM(args).run_log()
-        else:
-            TomoLog(args).run_log()
+        tomolog(args).run_log()
     elif file_path.is_dir():
         log.info("publishing a multiple files in: %s" % args.file_name)
         top = os.path.join(args.file_name, '')
@@ -49,34 +84,40 @@ def run_log(args):
         if (h5_file_list):
             # h5_file_list.sort()
             log.info("found: %s" % h5_file_list_sorted) 
-            index=0
-            for fname in h5_file_list_sorted:
-                args.file_name = top + fname
-                log.warning("  *** file %d/%d;  %s" % (index, len(h5_file_list_sorted), fname))
-                index += 1
-                try:
-                    if args.beamline == '32-id':
-                        TomoLog32ID(args).run_log()
-                    elif args.beamline == '2-bm':
-                        TomoLog2BM(args).run_log()
-                    elif args.beamline == '7-bm':
-                        TomoLog7BM(args).run_log()
-                    else:
-                        TomoLog(args).run_log()
-                except Exception as e:
-                    log.error("Failed to publish %s: %s — continuing batch", fname, e)
-                time.sleep(20)
+            if args.batch or args.workers > 0:
+                run_batch(args, top, h5_file_list_sorted)
+            else:
+                index=0
+                for fname in h5_file_list_sorted:
+                    args.file_name = top + fname
+                    log.warning("  *** file %d/%d;  %s" % (index, len(h5_file_list_sorted), fname))
+                    index += 1
+                    try:
+                        tomolog(args).run_log()
+                    except Exception as e:
+                        log.error("Failed to publish %s: %s — continuing batch", fname, e)
 
         else:
             log.error("directory %s does not contain any file" % args.file_name)
     else:
         log.error("directory or File Name does not exist: %s" % args.file_name)
 
-    # args.count = args.count + 1
-    config.write(args.config, args, sections=config.PARAMS)
-    log.warning('publication end')
-    log.info('presentation-url: %s' % args.presentation_url)
-    
+
+def run_bench(args):
+    if not bench.run(args, tomolog):
+        sys.exit(1)
+
+
+def run_batch(args, top, h5_file_list_sorted):
+    # read, plot, upload and publish the files in a pipeline, or in worker
+    # processes. The slides are published in the order of the files, in
+    # chunks of --batch-size slides
+    if args.workers > 0:
+        pipeline.run_workers(args, tomolog, top, h5_file_list_sorted)
+    else:
+        pipeline.run(args, tomolog, top, h5_file_list_sorted)
+
+
 def main():
 
     # make sure logs directory exists
@@ -92,6 +133,7 @@ def main():
     log.setup_custom_logger(lfname)
     log.info("Started tomolog")
     log.info("Saving log at %s" % lfname)
+    metrics.setup(lfname)
 
     parser = argparse.ArgumentParser()
     parser.add_argument('--config', **config.SECTIONS['general']['config'])
@@ -101,6 +143,7 @@ def main():
         ('init',        init,            (),     "Create configuration file"),
         ('run',         run_log,         params, "Run data logging to google slides"),
         ('status',      run_status,      params, "Show the tomolog status"),
+        ('bench',       run_bench,       ('bench',) + params, "Benchmark the publication of data sets"),
     ]
 
     subparsers = parser.add_subparsers(title="Commands", metavar='')
@@ -43,29 +43,125 @@
 # POSSIBILITY OF SUCH DAMAGE.                                             #
 # #########################################################################
 
+import os
 import re
-import socks
-import socket
-import httplib2
+import json
+import datetime
+import threading
+import google_auth_httplib2
 
 
 # from google.auth.transport.urllib3 import AuthorizedHttp
 from google_auth_httplib2 import AuthorizedHttp
-from googleapiclient.discovery import build
+from googleapiclient.discovery import build_from_document
+from googleapiclient import discovery_cache
 from google.oauth2 import service_account
 
 from tomolog_cli import log
+from tomolog_cli import utils
+from tomolog_cli import standin
+from tomolog_cli import transport
 from tomolog_cli import google_snippets
 
+# Access token cache shared by the tomolog processes of the host, saved in --token-home
+TOKEN_CACHE_FILE = 'google_access_token.json'
+# Cached tokens expiring within this time are refreshed
+TOKEN_EXPIRY_MARGIN = datetime.timedelta(minutes=5)
+
+# Slides clients established in this process, one per token file and network setup.
+# Each keeps its authorized transport and access token, refreshed only on expiry
+_connections = {}
+# render threads of --batch connect concurrently, each key is connected once
+_connections_lock = threading.Lock()
+_discovery_doc = None
+
 def google_slide(args, token_fname):
+    key = (token_fname, args.public, args.port, args.standin, args.dry_run)
+    with _connections_lock:
+        if key not in _connections:
+            if args.dry_run:
+                log.warning('Dry run: the slides are not published')
+                _connections[key] = google_snippets.DrySnippets()
+            elif args.standin:
+                _connections[key] = connect_standin(args)
+            else:
+                _connections[key] = connect(args, token_fname)
+        return _connections[key]
+
+def build_slides(**kwargs):
+    # use the slides discovery document bundled with googleapiclient, parsed once
+    # per process, instead of fetching and parsing it for every connection
+    global _discovery_doc
+    if _discovery_doc is None:
+        _discovery_doc = json.loads(discovery_cache.get_static_doc('slides', 'v1'))
+    return build_from_document(_discovery_doc, **kwargs)
+
+def load_token(creds, args, http):
+    '''
+    Set on *creds* the access token cached in --token-home. When the cached token
+    is missing, malformed or about to expire, exchange a new one and cache it.
+    The tokens refreshed later by the authorized transport are cached too.
+    '''
+    cache_fname = os.path.join(args.token_home, TOKEN_CACHE_FILE)
+    refresh = creds.refresh
+    with utils.file_lock(cache_fname + '.lock'):
+        cached = utils.read_json(cache_fname, {})
+        if cached_token(creds, cached):
+            log.info('Using google access token cached at %s' % cache_fname)
+        else:
+            log.info('Requesting a new google access token')
+            refresh(google_auth_httplib2.Request(http))
+            save_token(creds, cache_fname)
+
+    def refresh_and_save(request):
+        # AuthorizedHttp refreshes expired tokens during long runs: share them
+        # with the next tomolog processes instead of each refreshing again
+        refresh(request)
+        with utils.file_lock(cache_fname + '.lock'):
+            save_token(creds, cache_fname)
+    creds.refresh = refresh_and_save
+
+def cached_token(creds, cached):
+    '''Set on *creds* the token of the cache entry *cached*, return False when it cannot be used'''
+    if not isinstance(cached, dict) or cached.get('service_account') != creds.service_account_email:
+        return False
+    try:
+        token = cached['token']
+        expiry = datetime.datetime.fromisoformat(cached['expiry'])
+        # google-auth compares expiry with the naive utc time
+        fresh = expiry - datetime.datetime.utcnow() > TOKEN_EXPIRY_MARGIN
+    except (KeyError, TypeError, ValueError):
+        log.warning('Ignoring the malformed google access token cache entry')
+        return False
+    if not fresh or not isinstance(token, str):
+        return False
+    creds.token = token
+    creds.expiry = expiry
+    return True
+
+def save_token(creds, cache_fname):
+    utils.write_json(cache_fname, {
+        'service_account': creds.service_account_email,
+        'token':           creds.token,
+        'expiry':          creds.expiry.isoformat(),
+    }, mode=0o600)
+
+def connect_standin(args):
+    log.warning('Publishing to the local google slides stand-in, no slides are created on google')
+    slides = build_slides(http=transport.http(args), client_options={'api_endpoint': standin.url(args) + '/'})
+    return google_snippets.SlidesSnippets(slides, None, args.read_quota, args.write_quota)
+
+def connect(args, token_fname):
 
     log.info('Establishing connection to google')
     if(args.public):
         log.info('Running from a public network computer')
         try:
             creds = service_account.Credentials.from_service_account_file(token_fname).with_scopes(['https://www.googleapis.com/auth/presentations'])
-            slides = build('slides', 'v1', credentials=creds)
-            snippets = google_snippets.SlidesSnippets(slides, creds)
+            http = transport.http(args)
+            load_token(creds, args, http)
+            slides = build_slides(http=AuthorizedHttp(creds, http=http))
+            snippets = google_snippets.SlidesSnippets(slides, creds, args.read_quota, args.write_quota)
             log.info('Connection to google: OK')
             return snippets
         except FileNotFoundError:
@@ -73,19 +169,18 @@ def google_slide(args, token_fname):
             exit()
     else:
         log.info('Running from a private network computer')
-        # Monkey-patch socket to route through SOCKS5
-        socks.set_default_proxy(socks.SOCKS5, "127.0.0.1", args.port)
-        socket.socket = socks.socksocket
-
-        # Create an httplib2.Http instance with socks-configured socket
-        http = httplib2.Http()
+        # httplib2.Http instance routed through the SOCKS5 tunnel
+        http = transport.http(args)
 
         creds = service_account.Credentials.from_service_account_file(token_fname).with_scopes(['https://www.googleapis.com/auth/presentations'])
         authed_http = AuthorizedHttp(creds, http=http)
-        slides = build('slides', 'v1', http=authed_http)
+        slides = build_slides(http=authed_http)
+        snippets = google_snippets.SlidesSnippets(slides, creds, args.read_quota, args.write_quota)
         try:
-            # Replace 'YOUR_PRESENTATION_ID' with a valid one if available
-            slides.presentations().get(presentationId=extract_presentation_id(args.presentation_url)).execute()
+            load_token(creds, args, http)
+            # Fetching the slide count verifies the connection and caches the count
+            # used to insert the first slide of the run
+            snippets.slide_count(extract_presentation_id(args.presentation_url))
             log.info("✅ Google Slides API connection verified.")
             log.info("Presentation URL: %s" % args.presentation_url)
         except Exception as e:
@@ -94,7 +189,6 @@ def google_slide(args, token_fname):
             log.error('If this is a public network computer run tomolog using the --public option!')
             log.error('If this is a private network computer start on it an SSH tunnel: ssh -D %s user@public.machine.ip -N' % args.port)
             exit()
-        snippets = google_snippets.SlidesSnippets(slides, creds)
         return snippets
 
 def extract_presentation_id(slide_url):
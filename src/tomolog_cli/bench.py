@@ -0,0 +1,230 @@
+# #########################################################################
+# Copyright (c) 2022, UChicago Argonne, LLC. All rights reserved.         #
+#                                                                         #
+# Copyright 2022. UChicago Argonne, LLC. This software was produced       #
+# under U.S. Government contract DE-AC02-06CH11357 for Argonne National   #
+# Laboratory (ANL), which is operated by UChicago Argonne, LLC for the    #
+# U.S. Department of Energy. The U.S. Government has rights to use,       #
+# reproduce, and distribute this software.  NEITHER THE GOVERNMENT NOR    #
+# UChicago Argonne, LLC MAKES ANY WARRANTY, EXPRESS OR IMPLIED, OR        #
+# ASSUMES ANY LIABILITY FOR THE USE OF THIS SOFTWARE.  If software is     #
+# modified to produce derivative works, such modified software should     #
+# be clearly marked, so as not to confuse it with the version available   #
+# from ANL.                                                               #
+#                                                                         #
+# Additionally, redistribution and use in source and binary forms, with   #
+# or without modification, are permitted provided that the following      #
+# conditions are met:                                                     #
+#                                                                         #
+#     * Redistributions of source code must retain the above copyright    #
+#       notice, this list of conditions and the following disclaimer.     #
+#                                                                         #
+#     * Redistributions in binary form must reproduce the above copyright #
+#       notice, this list of conditions and the following disclaimer in   #
+#       the documentation and/or other materials provided with the        #
+#       distribution.                                                     #
+#                                                                         #
+#     * Neither the name of UChicago Argonne, LLC, Argonne National       #
+#       Laboratory, ANL, the U.S. Government, nor the names of its        #
+#       contributors may be used to endorse or promote products derived   #
+#       from this software without specific prior written permission.     #
+#                                                                         #
+# THIS SOFTWARE IS PROVIDED BY UChicago Argonne, LLC AND CONTRIBUTORS     #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT       #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS       #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL UChicago     #
+# Argonne, LLC OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,        #
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,    #
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;        #
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER        #
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT      #
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN       #
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE         #
+# POSSIBILITY OF SUCH DAMAGE.                                             #
+# #########################################################################
+
+'''
+    Benchmark of the publication of data sets::
+
+        tomolog bench --beamline 2-bm --bench-sizes 1k,2k --bench-layouts h5,tiff --bench-runs 5
+
+    Each data set, given with --bench-data or synthetic, is published --bench-runs
+    times on --bench-backend. The throughput, the median and 95th percentile of the
+    stage times, the bytes read and the peak RSS are reported, saved in --bench-output
+    and compared with the ones of --bench-baseline, when set, to catch regressions.
+'''
+import os
+import time
+import resource
+import numpy as np
+
+from tomolog_cli import log
+from tomolog_cli import utils
+from tomolog_cli import metrics
+from tomolog_cli import standin
+from tomolog_cli import synthetic
+
+__author__ = "Viktor Nikitin,  Francesco De Carlo"
+__copyright__ = "Copyright (c) 2022, UChicago Argonne, LLC."
+__docformat__ = 'restructuredtext en'
+__all__ = ['STAGES',
+           'datasets',
+           'bench_dataset',
+           'run', ]
+
+STAGES = ('read meta', 'read raw', 'read recon', 'find_min_max', 'plot', 'encode', 'upload', 'slides API')
+# presentation used on the stand-in and in dry runs when --presentation-url is not set
+BENCH_URL = 'https://docs.google.com/presentation/d/tomolog-bench/edit'
+# stage times below this are not checked against the baseline
+MIN_CHECKED_TIME = 0.05
+
+
+def setup_backend(args):
+    # uploads are not reused from the cache, each publication uploads its images
+    args.upload_cache_ttl = 0
+    if args.bench_backend == 'standin':
+        args.standin, args.dry_run = True, False
+        args.cloud_service = 'imgur'
+    elif args.bench_backend == 'dry':
+        args.standin, args.dry_run = False, True
+    if args.presentation_url is None:
+        if args.bench_backend == 'real':
+            raise RuntimeError('Set --presentation-url to benchmark the publication on google')
+        args.presentation_url = BENCH_URL
+
+
+def datasets(args):
+    '''Names, reconstruction layouts and raw file names of the benchmarked data sets'''
+    if args.bench_data is not None:
+        path = args.bench_data
+        if os.path.isdir(path):
+            fnames = [os.path.join(path, f) for f in os.listdir(path) if f.endswith(('.h5', '.hdf', 'hdf5'))]
+            fnames = sorted(fnames, key=lambda x: x.split('_')[-1])
+        else:
+            fnames = [path]
+        return [(os.path.basename(os.path.normpath(path)), args.save_format, fnames)]
+    cases = []
+    for size in [s.strip() for s in args.bench_sizes.split(',')]:
+        for layout in [s.strip() for s in args.bench_layouts.split(',')]:
+            fnames = synthetic.write_dataset(args.bench_dir, args.beamline, size, args.bench_height, layout)
+            cases.append((f'{args.beamline} {layout} {size}', layout, fnames))
+    return cases
+
+
+def publish(args, tomolog, fname):
+    '''Publish fname and return its time and the stages it ran'''
+    args.file_name = fname
+    # the cross sections and the contrast are found for each data set
+    args.idx, args.idy, args.idz = -1, -1, -1
+    args.min, args.max = 0, 0
+    first = len(metrics.records())
+    start = time.perf_counter()
+    tomolog(args).run_log()
+    elapsed = time.perf_counter() - start
+    return elapsed, metrics.records()[first:]
+
+
+def bench_dataset(args, tomolog, fnames):
+    '''
+    Publish the files --bench-runs times and return the throughput, stage times and
+    memory use. The memory peaks are traced in one more publication of the files:
+    tracemalloc slows down the stages several times, the timed runs are not traced.
+    '''
+    times = []
+    stage_times = {name: [] for name in STAGES}
+    peaks = dict.fromkeys(STAGES, 0)
+    bytes_read = 0
+    metrics.trace_memory()
+    for fname in fnames:
+        log.warning('  *** memory run;  %s' % os.path.basename(fname))
+        for record in publish(args, tomolog, fname)[1]:
+            if record['stage'] in peaks:
+                peaks[record['stage']] = max(peaks[record['stage']], record.get('peak_memory', 0))
+    metrics.stop_memory()
+    for k in range(args.bench_runs):
+        for fname in fnames:
+            log.warning('  *** run %d/%d;  %s' % (k, args.bench_runs, os.path.basename(fname)))
+            elapsed, records = publish(args, tomolog, fname)
+            times.append(elapsed)
+            # a stage can run several times for a data set, e.g. plot
+            totals = dict.fromkeys(STAGES, 0.0)
+            for record in records:
+                if record['stage'] in totals:
+                    totals[record['stage']] += record['seconds']
+                bytes_read += record.get('bytes_read', 0)
+            for name in STAGES:
+                stage_times[name].append(totals[name])
+    stage_times['total'] = times
+    peaks['total'] = max(peaks.values())
+    return {
+        'scans': len(times),
+        'scans_per_minute': 60 * len(times) / sum(times),
+        'bytes_read': bytes_read // len(times),
+        # maximum resident set size of the process so far, in kB on linux
+        'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        'stages': {name: {'p50': float(np.percentile(values, 50)),
+                          'p95': float(np.percentile(values, 95)),
+                          'peak_memory': peaks[name]}
+                   for name, values in stage_times.items()},
+    }
+
+
+def report(name, result):
+    log.info('Benchmark %s: %d publications, %.2f scans/minute, %.1f MB read per scan, peak RSS %.0f MB' % (
+        name, result['scans'], result['scans_per_minute'], result['bytes_read'] / 2**20, result['peak_rss'] / 2**20))
+    log.info('  {:<14} {:>10} {:>10} {:>12}'.format('stage', 'p50 s', 'p95 s', 'peak MB'))
+    for stage, value in result['stages'].items():
+        log.info('  {:<14} {:>10.3f} {:>10.3f} {:>12.1f}'.format(
+            stage, value['p50'], value['p95'], value['peak_memory'] / 2**20))
+
+
+def regressions(results, baseline, tolerance):
+    '''Compare the results with the baseline, return the list of regressions'''
+    found = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result['scans_per_minute'] * (1 + tolerance) < base['scans_per_minute']:
+            found.append('%s: %.2f scans/minute, baseline %.2f' % (name, result['scans_per_minute'], base['scans_per_minute']))
+        for stage, value in result['stages'].items():
+            base_stage = base['stages'].get(stage)
+            if base_stage is None:
+                continue
+            if value['p50'] > MIN_CHECKED_TIME and value['p50'] > base_stage['p50'] * (1 + tolerance):
+                found.append('%s %s: %.3f s, baseline %.3f s' % (name, stage, value['p50'], base_stage['p50']))
+            if value['peak_memory'] > base_stage['peak_memory'] * (1 + tolerance) + 2**20:
+                found.append('%s %s: %.1f MB, baseline %.1f MB' % (
+                    name, stage, value['peak_memory'] / 2**20, base_stage['peak_memory'] / 2**20))
+    return found
+
+
+def run(args, tomolog):
+    '''
+    Benchmark the data sets on --bench-backend. tomolog creates the TomoLog instance
+    of args.beamline. Return False on regressions against --bench-baseline.
+    '''
+    setup_backend(args)
+    results = {}
+    for name, layout, fnames in datasets(args):
+        args.save_format = layout
+        results[name] = bench_dataset(args, tomolog, fnames)
+        report(name, results[name])
+    metrics.report()
+    if args.standin:
+        standin.report()
+
+    utils.write_json(args.bench_output, results)
+    log.info('Benchmark results saved in %s' % args.bench_output)
+    if args.bench_baseline is None:
+        return True
+    baseline = utils.read_json(args.bench_baseline)
+    if baseline is None:
+        log.error('Baseline %s not found' % args.bench_baseline)
+        return False
+    found = regressions(results, baseline, args.bench_tolerance)
+    for line in found:
+        log.error('Regression %s' % line)
+    if not found:
+        log.info('No regressions against %s' % args.bench_baseline)
+    return not found
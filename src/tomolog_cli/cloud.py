@@ -43,40 +43,187 @@
 # POSSIBILITY OF SUCH DAMAGE.                                             #
 # #########################################################################
 
-import socks
-import socket
-import requests
 import subprocess
 import os
 import json
-import shutil
+import errno
 import traceback
 import uuid
+import time
+import socket
+import hashlib
+import threading
+import functools
+import http.server
 
 from time import sleep
+from concurrent.futures import ThreadPoolExecutor
 from tomolog_cli import log
+from tomolog_cli import metrics
+from tomolog_cli import utils
+from tomolog_cli import standin
+from tomolog_cli import transport
+
+# Images copied to a web server directory (aps, local), with their creation time.
+# Saved in --logs-home and removed in the background after --hosted-ttl hours
+HOSTED_IMAGES_FILE = 'tomolog_hosted_images.json'
+# Urls of the images already uploaded, keyed by cloud service and image content hash.
+# Saved in --logs-home and shared by the tomolog processes of the host
+UPLOAD_CACHE_FILE = 'tomolog_upload_cache.json'
+
+# Seconds before --hosted-ttl a hosted image url is no longer reused
+HOSTED_MARGIN = 600
+
+# Background uploads, started as soon as an image is saved
+_executor = None
+_count_lock = threading.Lock()
+
+
+def upload_async(args, image):
+    '''Start uploading *image* in the background and return the future of its url'''
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=transport.POOL_SIZE, thread_name_prefix='upload')
+    return _executor.submit(metrics.wrap(upload), args, image)
+
+
+def read_image(image):
+    # *image* is an in-memory image (see utils.image_buffer) or a file name
+    if isinstance(image, (str, os.PathLike)):
+        with open(image, 'rb') as f:
+            return os.path.basename(image), f.read()
+    return os.path.basename(image.name), image.getvalue()
+
+
+def _upload_cache_fname(args):
+    return os.path.join(args.logs_home, UPLOAD_CACHE_FILE)
+
+
+def _valid(args, entry):
+    ttl = args.upload_cache_ttl * 3600
+    if entry['path'] is not None:
+        # hosted images are removed by cleanup after --hosted-ttl: keep the margin
+        # for google to fetch the image before it is removed
+        ttl = min(ttl, args.hosted_ttl * 3600 - HOSTED_MARGIN)
+    if time.time() - entry['date'] > ttl:
+        return False
+    # images copied to a web server directory may have been removed since
+    return entry['path'] is None or os.path.exists(entry['path'])
+
+
+def _cached(args):
+    # urls of the stand-in and of the embedded image server end with the process
+    if args.upload_cache_ttl <= 0 or args.standin:
+        return False
+    return args.cloud_service != 'local' or args.local_url is not None
+
+
+def cached_url(args, digest):
+    '''Url of an image with content hash *digest* already uploaded to --cloud-service, if still valid'''
+    if not _cached(args):
+        return None
+    entry = utils.read_json(_upload_cache_fname(args), {}).get(f'{args.cloud_service}:{digest}')
+    if entry is None or not _valid(args, entry):
+        return None
+    return entry['url']
+
+
+def cache_url(args, digest, url, path=None):
+    if not _cached(args):
+        return
+    cache_fname = _upload_cache_fname(args)
+    try:
+        with utils.file_lock(cache_fname + '.lock'):
+            cache = utils.read_json(cache_fname, {})
+            # drop the expired entries so the cache does not grow forever
+            cache = {k: v for k, v in cache.items() if _valid(args, v)}
+            cache[f'{args.cloud_service}:{digest}'] = {'url': url, 'path': path, 'date': time.time()}
+            utils.write_json(cache_fname, cache)
+    except OSError as e:
+        log.warning('Could not update the upload cache %s: %s' % (cache_fname, e))
+
+
+class _QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        log.debug('local image server: ' + format % args)
 
-_remote_files = []
+    def list_directory(self, path):
+        # serve the images by name only, --local-dir holds the images of other runs
+        self.send_error(404, 'File not found')
+        return None
 
-def upload(args, filename):
 
-    if not args.public:
-        log.info("Running from a private network computer, using SOCKS5 proxy ...")
-        # Monkey-patch socket to route through SOCKS5
-        socks.set_default_proxy(socks.SOCKS5, "127.0.0.1", args.port)
-        # Upload the file through the SOCKS5 proxy
-        socket.socket = socks.socksocket
-    else:
-        log.info("Running from a public network computer ...")
+# Embedded image servers started by this process, one per served directory
+_servers = {}
+_server_lock = threading.Lock()
 
+
+def local_url(args):
+    '''Base url of the images in --local-dir, starting the embedded server when --local-url is not set'''
+    if args.local_url is not None:
+        return args.local_url.rstrip('/')
+    local_dir = os.path.abspath(args.local_dir)
+    with _server_lock:
+        if local_dir not in _servers:
+            handler = functools.partial(_QuietHandler, directory=local_dir)
+            try:
+                server = http.server.ThreadingHTTPServer((args.local_host, args.local_port), handler)
+            except OSError as e:
+                if e.errno != errno.EADDRINUSE:
+                    raise
+                # e.g. another tomolog run serving its images
+                log.warning('Port %d is in use, serving %s on a free port' % (args.local_port, local_dir))
+                server = http.server.ThreadingHTTPServer((args.local_host, 0), handler)
+            server.daemon_threads = True
+            threading.Thread(target=server.serve_forever, name='local-image-server', daemon=True).start()
+            _servers[local_dir] = f'http://{args.local_host or socket.getfqdn()}:{server.server_address[1]}'
+            log.info('Serving %s at %s' % (local_dir, _servers[local_dir]))
+    return _servers[local_dir]
+
+
+def local_upload(args, image, name, data):
+    # publish the image in --local-dir with a rename (or a hard link for images
+    # already on disk), so the web server never sees a partially written file
+    os.makedirs(args.local_dir, exist_ok=True)
+    dest_filename = f'{uuid.uuid4()}{os.path.splitext(name)[1]}'
+    dest_path = os.path.join(args.local_dir, dest_filename)
+    if isinstance(image, (str, os.PathLike)):
+        try:
+            os.link(image, dest_path)
+            return dest_path, dest_filename
+        except OSError:
+            pass
+    tmp_path = os.path.join(args.local_dir, f'.{dest_filename}.tmp')
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, dest_path)
+    return dest_path, dest_filename
+
+
+@metrics.timed('upload')
+def upload(args, image):
+
+    name, data = read_image(image)
+    if args.dry_run:
+        return 'dry-run://' + name
+    digest = hashlib.sha256(data).hexdigest()
+    url = cached_url(args, digest)
+    if url is not None:
+        log.info('*** Image %s already uploaded, reusing url %s' % (name, url))
+        return url
+
+    dest_path = None
     if args.cloud_service == 'imgur':
         cloud_url = 'https://uploadimgur.com/api/upload'
+        if args.standin:
+            cloud_url = standin.url(args) + '/api/upload'
         log.info('Uploading image to %s' % cloud_url)
-        with open(filename, "rb") as f:
-            response = requests.post(
-                cloud_url,
-                files={"image": f}
-            )
+        # pooled session: keep-alive connections through the tunnel are reused
+        response = transport.session(args).post(
+            cloud_url,
+            files={"image": (name, data)}
+        )
         headers = {
             "User-Agent": "curl/7.79.1"
         }
@@ -92,12 +239,15 @@ def upload(args, filename):
         log.info('Uploading image to aps web service')
         cloud_url = 'https://www3.xray.aps.anl.gov/tomolog'
         log.info('Uploading image to %s' % cloud_url)
-        ext = os.path.splitext(filename)[1]
+        ext = os.path.splitext(name)[1]
         dest_filename = f'{uuid.uuid4()}{ext}'
         dest_dir = '/net/joulefs/coulomb_Public/docroot/tomolog/'
         try:
-            dest_path = shutil.copy(filename, os.path.join(dest_dir, dest_filename))
-            _remote_files.append(dest_path)
+            dest_path = os.path.join(dest_dir, dest_filename)
+            # the image is written straight from memory to the web server directory
+            with open(dest_path, 'wb') as f:
+                f.write(data)
+            register_hosted(args, dest_path)
             log.info('Image copied to web server directory at %s' % dest_path)
             url = cloud_url + '/' + dest_filename
             log.info('*** Image url created %s' % url)
@@ -105,19 +255,76 @@ def upload(args, filename):
             traceback.print_exc()
         except PermissionError:
             traceback.print_exc()
-        except shutil.SameFileError:
-            traceback.print_exc()
         except Exception as e:
             traceback.print_exc()
-    args.count = args.count + 1
+    elif args.cloud_service == 'local':
+        cloud_url = local_url(args)
+        log.info('Uploading image to %s' % cloud_url)
+        dest_path, dest_filename = local_upload(args, image, name, data)
+        register_hosted(args, dest_path)
+        url = cloud_url + '/' + dest_filename
+        log.info('*** Image url created %s' % url)
+    if url is not None:
+        metrics.add('bytes_uploaded', len(data))
+    cache_url(args, digest, url, dest_path)
+    with _count_lock:
+        args.count = args.count + 1
     return url
 
 
+def _hosted_fname(args):
+    return os.path.join(args.logs_home, HOSTED_IMAGES_FILE)
+
+
+def register_hosted(args, path):
+    hosted_fname = _hosted_fname(args)
+    try:
+        with utils.file_lock(hosted_fname + '.lock'):
+            hosted = utils.read_json(hosted_fname, [])
+            hosted.append({'path': path, 'date': time.time()})
+            utils.write_json(hosted_fname, hosted)
+    except OSError as e:
+        log.warning('Could not register hosted image %s in %s: %s' % (path, hosted_fname, e))
+
+
 def cleanup(args):
-    for f in _remote_files:
-        try:
-            os.remove(f)
-            log.info('Removed temporary file %s' % f)
-        except Exception as e:
-            log.warning('Could not remove temporary file %s: %s' % (f, e))
-    _remote_files.clear()
+    '''
+    Start removing in the background the hosted images older than --hosted-ttl
+    hours, including the ones left over by tomolog runs that did not complete.
+    Returns the cleanup thread.
+    '''
+    thread = threading.Thread(target=_remove_expired, args=(args,), name='hosted-cleanup')
+    thread.start()
+    return thread
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+        log.info('Removed temporary file %s' % path)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        log.warning('Could not remove temporary file %s: %s' % (path, e))
+
+
+def _remove_expired(args):
+    hosted_fname = _hosted_fname(args)
+    if not os.path.exists(hosted_fname):
+        return
+    expiry = time.time() - args.hosted_ttl * 3600
+    try:
+        # the manifest is locked only to update it, the images are removed afterwards
+        with utils.file_lock(hosted_fname + '.lock'):
+            hosted = utils.read_json(hosted_fname, [])
+            expired = [h['path'] for h in hosted if h['date'] < expiry]
+            if expired:
+                utils.write_json(hosted_fname, [h for h in hosted if h['date'] >= expiry])
+    except OSError as e:
+        log.warning('Could not read hosted images from %s: %s' % (hosted_fname, e))
+        return
+    if expired:
+        log.info('Removing %d hosted images older than %s h' % (len(expired), args.hosted_ttl))
+        # removals on network file systems are slow, run them concurrently
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            executor.map(_remove, expired)
@@ -60,6 +60,7 @@ from tomolog_cli import log
 
 LOGS_HOME = os.path.join(str(pathlib.Path.home()), 'logs')
 CONFIG_FILE_NAME = os.path.join(str(pathlib.Path.home()), 'logs', 'tomolog.conf')
+BENCH_HOME      = os.path.join(str(pathlib.Path.home()), 'tomolog_bench')
 TOKEN_HOME      = os.path.join(str(pathlib.Path.home()), 'tokens')
 
 def default_parameter(func, param):
@@ -122,6 +123,14 @@ SECTIONS['general'] = {
         'default': False,
         'help': 'Verbose output',
         'action': 'store_true'},
+    'dry-run': {
+        'default': False,
+        'help': 'Read, plot and encode the data sets without uploading the images nor publishing the slides',
+        'action': 'store_true'},
+    'profile': {
+        'default': False,
+        'help': 'Profile the publication stages with cProfile and tracemalloc. Profiles and memory peaks are saved in --logs-home. Memory peaks are not traced with --batch, its stages run concurrently',
+        'action': 'store_true'},
     'config-update': {
         'default': False,
         'help': 'When set, the content of the config file is updated using the current params values',
@@ -134,6 +143,34 @@ SECTIONS['general'] = {
         'default': 1080,
         'type': int,
         'help': 'Port for tunneling'},
+    'standin': {
+        'default': False,
+        'help': 'Publish to local stand-ins of the google slides API and of imgur instead of the real services, e.g. to measure the publish throughput offline',
+        'action': 'store_true'},
+    'standin-latency': {
+        'type': float,
+        'default': 0,
+        'help': "Delay in ms added by the stand-ins to every request, e.g. to mimic the SOCKS tunnel"},
+    'batch': {
+        'default': False,
+        'help': 'When --file-name is a directory, read, plot, upload and publish the files in a pipeline, publishing the slides with multi-slide batchUpdate calls',
+        'action': 'store_true'},
+    'batch-size': {
+        'type': int,
+        'default': 10,
+        'help': "Number of slides published with each batchUpdate call when --batch is set"},
+    'render-workers': {
+        'type': int,
+        'default': 2,
+        'help': "Number of threads plotting and encoding the images when --batch is set"},
+    'read-ahead': {
+        'type': int,
+        'default': 2,
+        'help': "Number of data sets read ahead of the plotting threads when --batch is set"},
+    'workers': {
+        'type': int,
+        'default': 0,
+        'help': "When --file-name is a directory, number of processes preparing the slides. The slides are published in the order of the files, in chunks of --batch-size slides"},
     'idx': {
         'type': int,
         'default': -1,
@@ -149,7 +186,7 @@ SECTIONS['general'] = {
     'nproc': {
         'type': int,
         'default': 8,
-        'help': "Number of threads to read tiff"},
+        'help': "Number of threads to read tiff, and of processes to read h5 reconstructions larger than 1 GB"},
     'save-format': {
         'default': 'auto',
         'type': str,
@@ -213,15 +250,104 @@ SECTIONS['parameters'] = {
         'default': 'imgur',
         'type': str,
         'help': "cloud service where generated images will be uploaded. Google API retrieves images by url before publishing on slides",
-        'choices': ['imgur', 'aps']},
+        'choices': ['imgur', 'aps', 'local']},
+    'local-dir': {
+        'default': os.path.join(str(pathlib.Path.home()), 'tomolog_images'),
+        'type': str,
+        'help': "Directory of the images published with --cloud-service local",
+        'metavar': 'PATH'},
+    'local-url': {
+        'default': None,
+        'type': str,
+        'help': "Url of --local-dir when it is served by an existing web server. When not set, tomolog serves --local-dir with an embedded http server"},
+    'local-port': {
+        'type': int,
+        'default': 8000,
+        'help': "Port of the embedded http server serving --local-dir"},
+    'local-host': {
+        'type': str,
+        'default': '',
+        'help': "Address the embedded http server serving --local-dir listens on, e.g. the address google reaches the host at. All the interfaces when not set"},
+    'read-quota': {
+        'type': int,
+        'default': 300,
+        'help': "Google Slides API read requests per minute. Requests are throttled only when approaching this quota"},
+    'write-quota': {
+        'type': int,
+        'default': 60,
+        'help': "Google Slides API write requests per minute. Requests are throttled only when approaching this quota"},
+    'hosted-ttl': {
+        'type': float,
+        'default': 1,
+        'help': "Hours the images published with --cloud-service aps or local are kept before being removed by a background cleanup"},
+    'image-budget': {
+        'type': float,
+        'default': 250,
+        'help': "Size budget in kB of each uploaded image. The highest JPEG quality within the budget is used. Set to 0 for no limit"},
+    'image-scale': {
+        'type': float,
+        'default': 2.0,
+        'help': "Pixels per point of the uploaded images, relative to their size on the slide"},
+    'upload-cache-ttl': {
+        'type': float,
+        'default': 168,
+        'help': "Hours an uploaded image url is reused when an identical image is published again. Set to 0 to always upload"},
     'count': {
         'type': int,
         'default': 0,
         'help': "counter is incremented at each google slide generated. Conter is appended to the url to generate a unique url as required by some service"}
 }
 
+SECTIONS['bench'] = {
+    'bench-data': {
+        'default': None,
+        'type': str,
+        'help': "Data set file or directory published by the benchmark. When not set synthetic data sets are used",
+        'metavar': 'PATH'},
+    'bench-runs': {
+        'default': 3,
+        'type': int,
+        'help': "Number of times the data sets are published"},
+    'bench-backend': {
+        'default': 'standin',
+        'type': str,
+        'choices': ['real', 'standin', 'dry'],
+        'help': "Services used by the benchmark: real (--cloud-service and google), standin (local stand-ins) or dry (nothing uploaded nor published)"},
+    'bench-dir': {
+        'default': BENCH_HOME,
+        'type': str,
+        'help': "Directory of the synthetic data sets used by the benchmark. Data sets are written once and reused",
+        'metavar': 'PATH'},
+    'bench-sizes': {
+        'default': '1k',
+        'type': str,
+        'help': "Comma separated widths of the synthetic data sets: 1k, 2k, 4k"},
+    'bench-height': {
+        'default': 256,
+        'type': int,
+        'help': "Number of slices of the synthetic reconstructions"},
+    'bench-layouts': {
+        'default': 'h5,h5nolinks,tiff',
+        'type': str,
+        'help': "Comma separated reconstruction layouts of the synthetic data sets: h5, h5nolinks, tiff"},
+    'bench-output': {
+        'default': os.path.join(LOGS_HOME, 'tomolog_bench.json'),
+        'type': str,
+        'help': "File saving the stage times and memory peaks of the benchmark",
+        'metavar': 'FILE'},
+    'bench-baseline': {
+        'default': None,
+        'type': str,
+        'help': "Results of a previous benchmark. Stages slower or using more memory than the baseline are reported as regressions",
+        'metavar': 'FILE'},
+    'bench-tolerance': {
+        'default': 0.2,
+        'type': float,
+        'help': "Fraction above the baseline tolerated before reporting a regression"},
+}
+
 PARAMS = ('file-reading', 'parameters')
-NICE_NAMES = ('General', 'File reading', 'Parameters')
+NICE_NAMES = ('General', 'File reading', 'Parameters', 'Benchmark')
 
 
 def get_config_name():
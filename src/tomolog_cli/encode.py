@@ -0,0 +1,97 @@
+# #########################################################################
+# Copyright (c) 2022, UChicago Argonne, LLC. All rights reserved.         #
+#                                                                         #
+# Copyright 2022. UChicago Argonne, LLC. This software was produced       #
+# under U.S. Government contract DE-AC02-06CH11357 for Argonne National   #
+# Laboratory (ANL), which is operated by UChicago Argonne, LLC for the    #
+# U.S. Department of Energy. The U.S. Government has rights to use,       #
+# reproduce, and distribute this software.  NEITHER THE GOVERNMENT NOR    #
+# UChicago Argonne, LLC MAKES ANY WARRANTY, EXPRESS OR IMPLIED, OR        #
+# ASSUMES ANY LIABILITY FOR THE USE OF THIS SOFTWARE.  If software is     #
+# modified to produce derivative works, such modified software should     #
+# be clearly marked, so as not to confuse it with the version available   #
+# from ANL.                                                               #
+#                                                                         #
+# Additionally, redistribution and use in source and binary forms, with   #
+# or without modification, are permitted provided that the following      #
+# conditions are met:                                                     #
+#                                                                         #
+#     * Redistributions of source code must retain the above copyright    #
+#       notice, this list of conditions and the following disclaimer.     #
+#                                                                         #
+#     * Redistributions in binary form must reproduce the above copyright #
+#       notice, this list of conditions and the following disclaimer in   #
+#       the documentation and/or other materials provided with the        #
+#       distribution.                                                     #
+#                                                                         #
+#     * Neither the name of UChicago Argonne, LLC, Argonne National       #
+#       Laboratory, ANL, the U.S. Government, nor the names of its        #
+#       contributors may be used to endorse or promote products derived   #
+#       from this software without specific prior written permission.     #
+#                                                                         #
+# THIS SOFTWARE IS PROVIDED BY UChicago Argonne, LLC AND CONTRIBUTORS     #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT       #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS       #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL UChicago     #
+# Argonne, LLC OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,        #
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,    #
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;        #
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER        #
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT      #
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN       #
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE         #
+# POSSIBILITY OF SUCH DAMAGE.                                             #
+# #########################################################################
+
+'''
+    Encoding of the rendered images for their size on the slide.
+'''
+import io
+
+from PIL import Image
+
+from tomolog_cli import log
+from tomolog_cli import utils
+from tomolog_cli import metrics
+
+MIN_QUALITY = 30
+MAX_QUALITY = 95
+
+
+@metrics.timed('encode')
+def fit_image(image, width_pt, height_pt, scale, budget):
+    '''
+    Encode *image* as JPEG at the pixel size of its placement on the slide,
+    *width_pt* x *height_pt* points at *scale* pixels per point, using the highest
+    quality that keeps it within *budget* bytes (no limit when *budget* is 0).
+    '''
+    img = Image.open(io.BytesIO(image.getvalue()))
+    img = img.convert('RGB')
+    # google fits the image in the placement box keeping the aspect ratio
+    ratio = min(width_pt * scale / img.width, height_pt * scale / img.height)
+    if ratio < 1:
+        size = (max(1, round(img.width * ratio)), max(1, round(img.height * ratio)))
+        img = img.resize(size, Image.LANCZOS)
+
+    def encode(quality):
+        encoded = utils.image_buffer(image.name)
+        img.save(encoded, format='JPEG', quality=quality, optimize=True)
+        return encoded
+
+    if budget <= 0:
+        return encode(MAX_QUALITY)
+    # binary search of the highest quality within the budget
+    best = None
+    lo, hi = MIN_QUALITY, MAX_QUALITY
+    while lo <= hi:
+        quality = (lo + hi) // 2
+        encoded = encode(quality)
+        if len(encoded.getvalue()) <= budget:
+            best, lo = encoded, quality + 1
+        else:
+            hi = quality - 1
+    if best is None:
+        best = encode(MIN_QUALITY)
+        log.warning('%s exceeds the image budget of %d kB at the lowest quality' % (image.name, budget // 1024))
+    log.info('Encoded %s at %dx%d: %d kB' % (image.name, img.width, img.height, len(best.getvalue()) // 1024))
+    return best
@@ -43,235 +43,429 @@
 # POSSIBILITY OF SUCH DAMAGE.                                             #
 # #########################################################################
 
+import time
 import uuid
+import random
+import threading
+
+from concurrent.futures import Future
 
 from googleapiclient.http import MediaFileUpload
+from googleapiclient.errors import HttpError
 
 from tomolog_cli import log
+from tomolog_cli import metrics
 
+# Number of slides of each presentation published during this run. It is fetched
+# once per presentation with a field mask and updated locally after each insert
+_slide_counts = {}
 
-class SlidesSnippets(object):
-    def __init__(self, service, credentials):
-        self.service = service
-        self.credentials = credentials
+# Upper bound on the number of requests sent in one multi-slide batchUpdate call
+BATCH_MAX_REQUESTS = 500
 
-    def create_slide(self, presentation_id, page_id):
-        slides_service = self.service
-        # take the current number of slides
-        presentation = slides_service.presentations().get(
-            presentationId=presentation_id).execute()
-        nslides = len(presentation.get('slides'))
-        # insert a slide at the end
-        requests = [
-            {
-                'createSlide': {
-                    'objectId': page_id,
-                    'insertionIndex': nslides,#-1tmp for Julie
-                    'slideLayoutReference': {
-                        'predefinedLayout': 'BLANK'
-                    }
+# Google Slides API per-user quotas, requests per minute
+READ_QUOTA  = 300
+WRITE_QUOTA = 60
+
+# Retries of requests rejected for quota (429) or temporary server errors
+RETRY_STATUS = (429, 500, 503)
+# batchUpdate is not idempotent: after a server error it may have been applied, and
+# resending its createSlide object ids fails. Only quota rejections are retried
+BATCH_RETRY_STATUS = (429,)
+MAX_RETRIES  = 6
+BACKOFF_BASE = 1.0
+BACKOFF_MAX  = 64.0
+
+# Token buckets shared by all the Slides clients of the process
+_limiters = {}
+
+
+class RateLimiter(object):
+    '''
+    Token bucket allowing *rate* requests per minute. The bucket starts full, so
+    requests are throttled only when they approach the quota.
+    '''
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = float(rate)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate / 60)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) * 60 / self.rate
+                log.info('Approaching the google API quota of %d requests/minute, waiting %.1f s' % (self.rate, wait))
+                time.sleep(wait)
+
+
+def _limiter(kind, rate):
+    if kind not in _limiters or _limiters[kind].rate != rate:
+        _limiters[kind] = RateLimiter(rate)
+    return _limiters[kind]
+
+
+def _retry_delay(error, attempt):
+    # honour the delay requested by the server, otherwise back off exponentially
+    retry_after = error.resp.get('retry-after')
+    try:
+        delay = float(retry_after)
+    except (TypeError, ValueError):
+        delay = min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt)
+    return delay + random.uniform(0, BACKOFF_BASE)
+
+
+def _element_properties(page_id, magnitude_width, magnitude_height, posx, posy):
+    return {
+        'pageObjectId': page_id,
+        'size': {
+            'height': {'magnitude': magnitude_height, 'unit': 'PT'},
+            'width': {'magnitude': magnitude_width, 'unit': 'PT'}
+        },
+        'transform': {
+            'scaleX': 1,
+            'scaleY': 1,
+            'translateX': posx,
+            'translateY': posy,
+            'unit': 'PT'
+        }
+    }
+
+
+def _slide_requests(page_id, nslides):
+    # insert a slide at the end
+    return [
+        {
+            'createSlide': {
+                'objectId': page_id,
+                'insertionIndex': nslides,#-1tmp for Julie
+                'slideLayoutReference': {
+                    'predefinedLayout': 'BLANK'
                 }
             }
-        ]
-        # Execute the request.
-        body = {
-            'requests': requests
         }
-        response = slides_service.presentations().batchUpdate(presentationId=presentation_id, body=body).execute()
-        create_slide_response = response.get('replies')[0].get('createSlide')
-        log.info('Created slide with ID: {0}'.format(
-            create_slide_response.get('objectId')))
-        return response
-    
-    def create_textbox_with_text(self, presentation_id, page_id, text, magnitude_width, magnitude_height, posx, posy, fontsize, fontcolor):
-        slides_service = self.service
-        # [START slides_create_textbox_with_text]
-        # Create a new square textbox, using the supplied element ID.
-        element_id = str(uuid.uuid4())
-        requests = [
-            {
-                'createShape': {
-                    'objectId': element_id,
-                    'shapeType': 'TEXT_BOX',
-                    'elementProperties': {
-                        'pageObjectId': page_id,
-                        'size': {
-                            'height': {'magnitude': magnitude_height, 'unit': 'PT'},
-                            'width': {'magnitude': magnitude_width, 'unit': 'PT'}
-                        },
-                        'transform': {
-                            'scaleX': 1,
-                            'scaleY': 1,
-                            'translateX': posx,
-                            'translateY': posy,
-                            'unit': 'PT'
-                        }
-                    }
-                }
-            },
-
-            # Insert text into the box, using the supplied element ID.
-            {
-                'insertText': {
-                    'objectId': element_id,
-                    'insertionIndex': 0,
-                    'text': text
-                }
-            },
-            
-            {
-                'updateTextStyle': {
-                    'objectId': element_id,
-                    'style': {
-                        'fontFamily': 'Times New Roman',
-                        'fontSize': {
-                            'magnitude': fontsize,
-                            'unit': 'PT'
-                        },
-                        'foregroundColor': {
-                            'opaqueColor': {
-                                'rgbColor': {
-                                    'blue': 0.0,
-                                    'green': 0.0,
-                                    'red': fontcolor
-                                }
-                            }
-                        }                        
-                    },
-                    'fields': 'fontSize'
-                }
-            }            
-        ]
+    ]
 
-        # Execute the request.
-        body = {
-            'requests': requests
-        }
-        response = slides_service.presentations() \
-            .batchUpdate(presentationId=presentation_id, body=body).execute()
-        create_shape_response = response.get('replies')[0].get('createShape')
-        log.info('Created google slide textbox with ID: {0}'.format(
-            create_shape_response.get('objectId')))
-        # [END slides_create_textbox_with_text]
-        return response    
 
-    def create_textbox_with_bullets(self, presentation_id, page_id, text, magnitude_width, magnitude_height, posx, posy, fontsize, fontcolor):
-        slides_service = self.service
-        # [START slides_create_textbox_with_text]
-        # Create a new square textbox, using the supplied element ID.
-        if text=="":
-            return
-        element_id = str(uuid.uuid4())
-        requests = [
-            {
-                'createShape': {
-                    'objectId': element_id,
-                    'shapeType': 'TEXT_BOX',
-                    'elementProperties': {
-                        'pageObjectId': page_id,
-                        'size': {
-                            'height': {'magnitude': magnitude_height, 'unit': 'PT'},
-                            'width': {'magnitude': magnitude_width, 'unit': 'PT'}
-                        },
-                        'transform': {
-                            'scaleX': 1,
-                            'scaleY': 1,
-                            'translateX': posx,
-                            'translateY': posy,
-                            'unit': 'PT'
-                        }
-                    }
-                }
-            },
-
-            # Insert text into the box, using the supplied element ID.
-            {
-                'insertText': {
-                    'objectId': element_id,
-                    'insertionIndex': 0,
-                    'text': text
-                }
-            },
-            
-            {
-                'updateTextStyle': {
-                    'objectId': element_id,
-                    'style': {
-                        'fontFamily': 'Times New Roman',
-                        'fontSize': {
-                            'magnitude': fontsize,
-                            'unit': 'PT'
-                        },
-                        'foregroundColor': {
-                            'opaqueColor': {
-                                'rgbColor': {
-                                    'blue': 0.0,
-                                    'green': 0.0,
-                                    'red': fontcolor
-                                }
+def _textbox_requests(page_id, text, magnitude_width, magnitude_height, posx, posy, fontsize, fontcolor, fields='fontSize'):
+    # Create a new square textbox, using a new element ID.
+    element_id = str(uuid.uuid4())
+    return [
+        {
+            'createShape': {
+                'objectId': element_id,
+                'shapeType': 'TEXT_BOX',
+                'elementProperties': _element_properties(
+                    page_id, magnitude_width, magnitude_height, posx, posy)
+            }
+        },
+
+        # Insert text into the box, using the supplied element ID.
+        {
+            'insertText': {
+                'objectId': element_id,
+                'insertionIndex': 0,
+                'text': text
+            }
+        },
+
+        {
+            'updateTextStyle': {
+                'objectId': element_id,
+                'style': {
+                    'fontFamily': 'Times New Roman',
+                    'fontSize': {
+                        'magnitude': fontsize,
+                        'unit': 'PT'
+                    },
+                    'foregroundColor': {
+                        'opaqueColor': {
+                            'rgbColor': {
+                                'blue': 0.0,
+                                'green': 0.0,
+                                'red': fontcolor
                             }
                         }
-                    },
-                    'fields': 'foregroundColor,fontSize'
-                }
-            },
-            {
-                'createParagraphBullets': {
-                    'objectId': element_id,
-                    'textRange': {
-                        'type': 'ALL'
-                    },
-                    'bulletPreset': 'BULLET_DISC_CIRCLE_SQUARE'
-                }
+                    }
+                },
+                'fields': fields
             }
-        ]
+        }
+    ]
 
-        # Execute the request.
-        body = {
-            'requests': requests
+
+def _bullets_requests(page_id, text, magnitude_width, magnitude_height, posx, posy, fontsize, fontcolor):
+    requests = _textbox_requests(page_id, text, magnitude_width, magnitude_height,
+                                 posx, posy, fontsize, fontcolor, fields='foregroundColor,fontSize')
+    requests.append(
+        {
+            'createParagraphBullets': {
+                'objectId': requests[0]['createShape']['objectId'],
+                'textRange': {
+                    'type': 'ALL'
+                },
+                'bulletPreset': 'BULLET_DISC_CIRCLE_SQUARE'
+            }
         }
-        response = slides_service.presentations() \
-            .batchUpdate(presentationId=presentation_id, body=body).execute()
-        create_shape_response = response.get('replies')[0].get('createShape')
-        log.info('Created google slide textbox bullets with ID: {0}'.format(
-            create_shape_response.get('objectId')))
-        return response            
-    
-    def create_image(self, presentation_id, page_id, IMAGE_URL, magnitude_width, magnitude_height, posx, posy):
-        slides_service = self.service
-        # [START slides_create_image]
-        # Create a new image, using the supplied object ID,
-        # with content downloaded from IMAGE_URL.
-        requests = []
-        image_id = str(uuid.uuid4())
-        requests.append({
+    )
+    return requests
+
+
+def _image_requests(page_id, IMAGE_URL, magnitude_width, magnitude_height, posx, posy):
+    # Create a new image, using a new object ID,
+    # with content downloaded from IMAGE_URL.
+    image_id = str(uuid.uuid4())
+    return [
+        {
             'createImage': {
                 'objectId': image_id,
                 'url': IMAGE_URL,
-                'elementProperties': {
-                    'pageObjectId': page_id,
-                    'size': {
-                        'height': {'magnitude': magnitude_height, 'unit': 'PT'},
-                        'width': {'magnitude': magnitude_width, 'unit': 'PT'},
-                    },
-                    'transform': {
-                        'scaleX': 1,
-                        'scaleY': 1,
-                        'translateX': posx,
-                        'translateY': posy,
-                        'unit': 'PT'
-                    }
-                }
+                'elementProperties': _element_properties(
+                    page_id, magnitude_width, magnitude_height, posx, posy)
             }
-        })
+        }
+    ]
+
+
+def _log_replies(response):
+    for reply in response.get('replies', []):
+        if 'createSlide' in reply:
+            log.info('Created slide with ID: {0}'.format(
+                reply['createSlide'].get('objectId')))
+        elif 'createShape' in reply:
+            log.info('Created google slide textbox with ID: {0}'.format(
+                reply['createShape'].get('objectId')))
+        elif 'createImage' in reply:
+            log.info('Created google slide image with ID: {0}'.format(
+                reply['createImage'].get('objectId')))
+
+
+def flush_slides(builders, batch_size):
+    '''
+    Publish the slides collected by several builders of the same presentation
+    with chunked multi-slide batchUpdate calls of at most *batch_size* slides.
+    A failed chunk or slide is logged and the other slides are still published.
+    '''
+    for b in builders:
+        b.resolve()
+    pending = [b for b in builders if b.requests]
+    while pending:
+        chunk = [pending.pop(0)]
+        nrequests = len(chunk[0].requests)
+        while pending and len(chunk) < batch_size and \
+                nrequests + len(pending[0].requests) <= BATCH_MAX_REQUESTS:
+            nrequests += len(pending[0].requests)
+            chunk.append(pending.pop(0))
+        try:
+            _flush_chunk(chunk)
+        except Exception as e:
+            # network errors are not retried by execute
+            log.error("Failed to publish %d slides: %s — continuing batch", len(chunk), e)
+
 
-        # Execute the request.
+def _flush_chunk(chunk):
+    if len(chunk) == 1:
+        chunk[0].flush()
+        return
+    first = chunk[0]
+    requests = [r for b in chunk for r in b.requests]
+    log.info('Publishing %d slides with %d requests' % (len(chunk), len(requests)))
+    merged = SlideBuilder(first.snippets, first.presentation_id, first.page_id)
+    ninserted = merged._set_insertion_index(requests)
+    try:
+        response = merged._batch_update(requests, ninserted)
+    except HttpError as e:
+        # batchUpdate is atomic: a single bad request drops all slides of the chunk
+        log.error('Failed to publish %d slides: %s' % (len(chunk), e))
+        log.warning('Publishing the slides one by one')
+        for b in chunk:
+            try:
+                b.flush()
+            except Exception as e:
+                log.error("Failed to publish slide %s: %s — continuing batch", b.page_id, e)
+        return
+    first.snippets.slides_inserted(first.presentation_id, ninserted)
+    _log_replies(response)
+    for b in chunk:
+        b.requests = []
+
+
+class SlidesSnippets(object):
+    def __init__(self, service, credentials, read_quota=READ_QUOTA, write_quota=WRITE_QUOTA):
+        self.service = service
+        self.credentials = credentials
+        self.read_limiter = _limiter('read', read_quota)
+        self.write_limiter = _limiter('write', write_quota)
+
+    @metrics.timed('slides API')
+    def execute(self, request, limiter, retry_status=RETRY_STATUS):
+        for attempt in range(MAX_RETRIES + 1):
+            limiter.acquire()
+            metrics.add('api_calls')
+            try:
+                return request.execute()
+            except HttpError as e:
+                if e.resp.status not in retry_status or attempt == MAX_RETRIES:
+                    raise
+                delay = _retry_delay(e, attempt)
+                log.warning('Google API returned %s, retrying in %.1f s' % (e.resp.status, delay))
+                metrics.add('api_retries')
+                time.sleep(delay)
+
+    def batch_update(self, presentation_id, requests):
         body = {
             'requests': requests
         }
-        response = slides_service.presentations() \
-            .batchUpdate(presentationId=presentation_id, body=body).execute()
-        create_image_response = response.get('replies')[0].get('createImage')
-        log.info('Created google slide image with ID: {0}'.format(
-        create_image_response.get('objectId')))        
+        return self.execute(self.service.presentations() \
+            .batchUpdate(presentationId=presentation_id, body=body), self.write_limiter, BATCH_RETRY_STATUS)
+
+    def slide_count(self, presentation_id, refresh=False):
+        if refresh or presentation_id not in _slide_counts:
+            # only the slide ids are needed, not the full presentation content
+            presentation = self.execute(self.service.presentations().get(
+                presentationId=presentation_id, fields='slides.objectId'), self.read_limiter)
+            _slide_counts[presentation_id] = len(presentation.get('slides', []))
+        return _slide_counts[presentation_id]
+
+    def slides_inserted(self, presentation_id, nslides=1):
+        if presentation_id in _slide_counts:
+            _slide_counts[presentation_id] += nslides
+
+    def slide_builder(self, presentation_id, page_id):
+        return SlideBuilder(self, presentation_id, page_id)
+
+    def create_slide(self, presentation_id, page_id):
+        # take the current number of slides
+        nslides = self.slide_count(presentation_id)
+        response = self.batch_update(presentation_id, _slide_requests(page_id, nslides))
+        self.slides_inserted(presentation_id)
+        _log_replies(response)
+        return response
+
+    def create_textbox_with_text(self, presentation_id, page_id, text, magnitude_width, magnitude_height, posx, posy, fontsize, fontcolor):
+        response = self.batch_update(presentation_id, _textbox_requests(
+            page_id, text, magnitude_width, magnitude_height, posx, posy, fontsize, fontcolor))
+        _log_replies(response)
+        return response
+
+    def create_textbox_with_bullets(self, presentation_id, page_id, text, magnitude_width, magnitude_height, posx, posy, fontsize, fontcolor):
+        if text=="":
+            return
+        response = self.batch_update(presentation_id, _bullets_requests(
+            page_id, text, magnitude_width, magnitude_height, posx, posy, fontsize, fontcolor))
+        _log_replies(response)
+        return response
+
+    def create_image(self, presentation_id, page_id, IMAGE_URL, magnitude_width, magnitude_height, posx, posy):
+        response = self.batch_update(presentation_id, _image_requests(
+            page_id, IMAGE_URL, magnitude_width, magnitude_height, posx, posy))
+        _log_replies(response)
+        return response
+
+
+class DrySnippets(SlidesSnippets):
+    '''Collect the slides without sending them to google, for --dry-run and the batch workers'''
+    def __init__(self):
+        super().__init__(None, None)
+
+    def batch_update(self, presentation_id, requests):
+        log.info('Dry run: %d requests not sent to google' % len(requests))
+        return {'replies': []}
+
+    def slide_count(self, presentation_id, refresh=False):
+        return _slide_counts.setdefault(presentation_id, 0)
+
+
+class SlideBuilder(object):
+    '''
+    Accumulate the requests creating one slide and send them to google with a
+    single batchUpdate call when flushed.
+    '''
+
+    def __init__(self, snippets, presentation_id, page_id):
+        self.snippets = snippets
+        self.presentation_id = presentation_id
+        self.page_id = page_id
+        self.requests = []
+
+    def create_slide(self):
+        # the insertion index is set from the cached slide count when flushing
+        self.requests.extend(_slide_requests(self.page_id, None))
+
+    def create_textbox_with_text(self, text, magnitude_width, magnitude_height, posx, posy, fontsize, fontcolor):
+        self.requests.extend(_textbox_requests(
+            self.page_id, text, magnitude_width, magnitude_height, posx, posy, fontsize, fontcolor))
+
+    def create_textbox_with_bullets(self, text, magnitude_width, magnitude_height, posx, posy, fontsize, fontcolor):
+        if text=="":
+            return
+        self.requests.extend(_bullets_requests(
+            self.page_id, text, magnitude_width, magnitude_height, posx, posy, fontsize, fontcolor))
+
+    def create_image(self, IMAGE_URL, magnitude_width, magnitude_height, posx, posy):
+        # IMAGE_URL may be the future of an upload still running, see resolve()
+        self.requests.extend(_image_requests(
+            self.page_id, IMAGE_URL, magnitude_width, magnitude_height, posx, posy))
+
+    def resolve(self):
+        '''Wait for the image uploads and set their urls, drop the images that failed'''
+        requests = []
+        for request in self.requests:
+            if 'createImage' in request and isinstance(request['createImage']['url'], Future):
+                try:
+                    request['createImage']['url'] = request['createImage']['url'].result()
+                except Exception as e:
+                    log.error('Image upload failed, skipping the image: %s' % e)
+                    continue
+            requests.append(request)
+        self.requests = requests
+
+    def _set_insertion_index(self, requests, refresh=False):
+        nslides = self.snippets.slide_count(self.presentation_id, refresh=refresh)
+        ninserted = 0
+        for request in requests:
+            if 'createSlide' in request:
+                request['createSlide']['insertionIndex'] = nslides + ninserted
+                ninserted += 1
+        return ninserted
+
+    def _batch_update(self, requests, ninserted):
+        try:
+            return self.snippets.batch_update(self.presentation_id, requests)
+        except HttpError as e:
+            if ninserted == 0 or 'createSlide' not in str(e):
+                raise
+            # the cached slide count is stale when slides were removed by hand
+            # during the run: fetch it again and retry once
+            log.warning('Refreshing the slide count of the presentation')
+            self._set_insertion_index(requests, refresh=True)
+            return self.snippets.batch_update(self.presentation_id, requests)
+
+    def flush(self):
+        self.resolve()
+        if not self.requests:
+            return None
+        requests, self.requests = self.requests, []
+        log.info('Publishing slide %s with %d requests' % (self.page_id, len(requests)))
+        ninserted = self._set_insertion_index(requests)
+        try:
+            response = self._batch_update(requests, ninserted)
+        except HttpError as e:
+            # batchUpdate is atomic: one image google cannot fetch drops the whole
+            # slide. Publish the text so the scan still shows up in the log.
+            text_only = [r for r in requests if 'createImage' not in r]
+            if len(text_only) == len(requests):
+                raise
+            log.error('Failed to publish slide %s: %s' % (self.page_id, e))
+            log.warning('Publishing slide %s without images' % self.page_id)
+            response = self._batch_update(text_only, ninserted)
+        self.snippets.slides_inserted(self.presentation_id, ninserted)
+        _log_replies(response)
         return response
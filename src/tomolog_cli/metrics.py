@@ -0,0 +1,309 @@
+# #########################################################################
+# Copyright (c) 2022, UChicago Argonne, LLC. All rights reserved.         #
+#                                                                         #
+# Copyright 2022. UChicago Argonne, LLC. This software was produced       #
+# under U.S. Government contract DE-AC02-06CH11357 for Argonne National   #
+# Laboratory (ANL), which is operated by UChicago Argonne, LLC for the    #
+# U.S. Department of Energy. The U.S. Government has rights to use,       #
+# reproduce, and distribute this software.  NEITHER THE GOVERNMENT NOR    #
+# UChicago Argonne, LLC MAKES ANY WARRANTY, EXPRESS OR IMPLIED, OR        #
+# ASSUMES ANY LIABILITY FOR THE USE OF THIS SOFTWARE.  If software is     #
+# modified to produce derivative works, such modified software should     #
+# be clearly marked, so as not to confuse it with the version available   #
+# from ANL.                                                               #
+#                                                                         #
+# Additionally, redistribution and use in source and binary forms, with   #
+# or without modification, are permitted provided that the following      #
+# conditions are met:                                                     #
+#                                                                         #
+#     * Redistributions of source code must retain the above copyright    #
+#       notice, this list of conditions and the following disclaimer.     #
+#                                                                         #
+#     * Redistributions in binary form must reproduce the above copyright #
+#       notice, this list of conditions and the following disclaimer in   #
+#       the documentation and/or other materials provided with the        #
+#       distribution.                                                     #
+#                                                                         #
+#     * Neither the name of UChicago Argonne, LLC, Argonne National       #
+#       Laboratory, ANL, the U.S. Government, nor the names of its        #
+#       contributors may be used to endorse or promote products derived   #
+#       from this software without specific prior written permission.     #
+#                                                                         #
+# THIS SOFTWARE IS PROVIDED BY UChicago Argonne, LLC AND CONTRIBUTORS     #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT       #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS       #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL UChicago     #
+# Argonne, LLC OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,        #
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,    #
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;        #
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER        #
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT      #
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN       #
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE         #
+# POSSIBILITY OF SUCH DAMAGE.                                             #
+# #########################################################################
+
+'''
+    Timing of the publication stages. Each stage is saved as a json line in the
+    metrics file next to the log file and summarized at the end of the run.
+    When profiling, the stages also run under cProfile and tracemalloc.
+'''
+import os
+import json
+import time
+import pstats
+import cProfile
+import datetime
+import tracemalloc
+import functools
+import threading
+import contextlib
+
+from collections import OrderedDict
+
+from tomolog_cli import log
+
+# counters added to the current stage of the thread
+COUNTERS = ('bytes_read', 'bytes_uploaded', 'api_calls', 'api_retries')
+
+_fname = None
+_lock = threading.Lock()
+_local = threading.local()
+_summary = OrderedDict()
+_records = []
+# memory peaks of the stages are traced
+_memory = False
+# prefix of the profile files, set when profiling
+_profile = None
+_profiles = OrderedDict()
+
+
+def setup(lfname):
+    '''Save the stages in the json lines file of the log file lfname'''
+    global _fname
+    _fname = os.path.splitext(lfname)[0] + '.jsonl'
+    log.info('Saving metrics at %s' % _fname)
+    return _fname
+
+
+def current_scan():
+    return getattr(_local, 'scan', None)
+
+
+@contextlib.contextmanager
+def scan(name):
+    '''Attribute the stages run by this thread to the data set name'''
+    previous = current_scan()
+    _local.scan = name
+    try:
+        yield
+    finally:
+        _local.scan = previous
+
+
+def wrap(func):
+    '''Return func running in another thread with the data set of the calling thread'''
+    name = current_scan()
+
+    @functools.wraps(func)
+    def run(*args, **kwargs):
+        with scan(name):
+            return func(*args, **kwargs)
+    return run
+
+
+def trace_memory():
+    '''Trace the memory peak of each stage with tracemalloc'''
+    global _memory
+    _memory = True
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def stop_memory():
+    '''Stop tracing the memory peaks, tracemalloc slows down the stages several times'''
+    global _memory
+    _memory = False
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def start_profile(prefix, memory=True):
+    '''
+    Profile the stages with cProfile and, when memory is set, trace their memory
+    peaks. The profiles are saved in prefix_<stage>.pstats and the peaks in
+    prefix_memory.txt by report. Only the stages of the main thread are traced.
+    '''
+    global _profile
+    _profile = prefix
+    if memory:
+        trace_memory()
+    log.warning('Profiling the stages, saving the profiles at %s_*.pstats' % prefix)
+
+
+def _pause(record):
+    # stop profiling record while a nested stage runs
+    profiler = record.get('profiler')
+    if profiler is not None:
+        profiler.disable()
+    if 'memory' in record:
+        _update_peak(record)
+
+
+def _traced():
+    # the tracemalloc peak is shared by the threads: only the stages of the main
+    # thread reset it, the stages of the upload and --batch threads are not traced
+    return _memory and threading.current_thread() is threading.main_thread()
+
+
+def _resume(record):
+    if 'memory' in record:
+        tracemalloc.reset_peak()
+    profiler = record.get('profiler')
+    if profiler is not None:
+        profiler.enable()
+
+
+def _update_peak(record):
+    peak = tracemalloc.get_traced_memory()[1] - record['memory']
+    record['peak_memory'] = max(record.get('peak_memory', 0), peak)
+
+
+@contextlib.contextmanager
+def stage(name):
+    '''
+    Time the stage name. Nested stages are timed on their own: the time of a
+    stage does not include the time of the stages it runs.
+    '''
+    stack = _local.__dict__.setdefault('stack', [])
+    parent = stack[-1] if stack else None
+    record = {'stage': name, 'scan': current_scan(), 'nested': 0.0}
+    if parent is not None:
+        _pause(parent)
+    if _traced():
+        record['memory'] = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+    if _profile is not None:
+        try:
+            record['profiler'] = cProfile.Profile()
+            record['profiler'].enable()
+        except ValueError:
+            # a single profiler runs at a time on python >= 3.12, the stage is only timed
+            record.pop('profiler')
+    stack.append(record)
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        elapsed = time.perf_counter() - start
+        stack.pop()
+        _pause(record)
+        if parent is not None:
+            _resume(parent)
+            parent['nested'] += elapsed
+        record['seconds'] = elapsed - record.pop('nested')
+        _save(record)
+
+
+def timed(name):
+    '''Decorator timing each call of the function as the stage name'''
+    def decorator(func):
+        @functools.wraps(func)
+        def run(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return run
+    return decorator
+
+
+def add(counter, value=1):
+    '''Add value to the counter of the current stage of this thread'''
+    stack = getattr(_local, 'stack', None)
+    if stack:
+        stack[-1][counter] = stack[-1].get(counter, 0) + value
+
+
+def _save(record):
+    record['date'] = datetime.datetime.now().isoformat(timespec='milliseconds')
+    profiler = record.pop('profiler', None)
+    record.pop('memory', None)
+    with _lock:
+        _add(record)
+        if profiler is not None:
+            if record['stage'] in _profiles:
+                _profiles[record['stage']].add(profiler)
+            else:
+                _profiles[record['stage']] = pstats.Stats(profiler)
+        if _fname is not None:
+            with open(_fname, 'a') as fid:
+                fid.write(json.dumps(record) + '\n')
+
+
+def _add(record):
+    total = _summary.setdefault(record['stage'], dict.fromkeys(('count', 'seconds', 'max', 'peak_memory') + COUNTERS, 0))
+    total['count'] += 1
+    total['seconds'] += record['seconds']
+    total['max'] = max(total['max'], record['seconds'])
+    total['peak_memory'] = max(total['peak_memory'], record.get('peak_memory', 0))
+    for counter in COUNTERS:
+        total[counter] += record.get(counter, 0)
+    _records.append(record)
+
+
+def merge(records):
+    '''Add the stages saved by another process, e.g. a batch worker, to the summary'''
+    with _lock:
+        for record in records:
+            _add(record)
+
+
+def records():
+    '''Stages saved since the start of the run'''
+    with _lock:
+        return list(_records)
+
+
+def summary():
+    '''Totals of each stage since the start of the run'''
+    with _lock:
+        return OrderedDict((name, dict(total)) for name, total in _summary.items())
+
+
+def report():
+    totals = summary()
+    if not totals:
+        return
+    log.info('Stage summary:')
+    log.info('  {:<14} {:>6} {:>10} {:>9} {:>9} {:>12} {:>12} {:>6}'.format(
+        'stage', 'count', 'total s', 'mean s', 'max s', 'MB read', 'MB uploaded', 'calls'))
+    for name, total in totals.items():
+        log.info('  {:<14} {:>6} {:>10.2f} {:>9.3f} {:>9.3f} {:>12.1f} {:>12.1f} {:>6}'.format(
+            name, total['count'], total['seconds'], total['seconds'] / total['count'], total['max'],
+            total['bytes_read'] / 2**20, total['bytes_uploaded'] / 2**20, total['api_calls']))
+    if _fname is not None:
+        with _lock:
+            with open(_fname, 'a') as fid:
+                fid.write(json.dumps({'summary': totals}) + '\n')
+    if _profile is not None:
+        report_profile(totals)
+
+
+def report_profile(totals):
+    '''Save the profile of each stage and the report of the memory peaks'''
+    with _lock:
+        for name, stats in _profiles.items():
+            stats.dump_stats('%s_%s.pstats' % (_profile, name.replace(' ', '_')))
+    log.info('Profiles saved at %s_*.pstats, read them with: python -m pstats <file>' % _profile)
+    if not _memory:
+        return
+    lines = ['{:<14} {:>6} {:>10} {:>14}'.format('stage', 'count', 'total s', 'peak MB')]
+    for name, total in totals.items():
+        lines.append('{:<14} {:>6} {:>10.2f} {:>14.1f}'.format(
+            name, total['count'], total['seconds'], total['peak_memory'] / 2**20))
+    # the stages of the background threads, e.g. upload, show no peak
+    note = 'Memory peaks of the stages run by the main thread, the stages of other threads are not traced'
+    with open(_profile + '_memory.txt', 'w') as fid:
+        fid.write('\n'.join([note] + lines) + '\n')
+    log.info(note + ':')
+    for line in lines:
+        log.info('  ' + line)
@@ -0,0 +1,261 @@
+# #########################################################################
+# Copyright (c) 2022, UChicago Argonne, LLC. All rights reserved.         #
+#                                                                         #
+# Copyright 2022. UChicago Argonne, LLC. This software was produced       #
+# under U.S. Government contract DE-AC02-06CH11357 for Argonne National   #
+# Laboratory (ANL), which is operated by UChicago Argonne, LLC for the    #
+# U.S. Department of Energy. The U.S. Government has rights to use,       #
+# reproduce, and distribute this software.  NEITHER THE GOVERNMENT NOR    #
+# UChicago Argonne, LLC MAKES ANY WARRANTY, EXPRESS OR IMPLIED, OR        #
+# ASSUMES ANY LIABILITY FOR THE USE OF THIS SOFTWARE.  If software is     #
+# modified to produce derivative works, such modified software should     #
+# be clearly marked, so as not to confuse it with the version available   #
+# from ANL.                                                               #
+#                                                                         #
+# Additionally, redistribution and use in source and binary forms, with   #
+# or without modification, are permitted provided that the following      #
+# conditions are met:                                                     #
+#                                                                         #
+#     * Redistributions of source code must retain the above copyright    #
+#       notice, this list of conditions and the following disclaimer.     #
+#                                                                         #
+#     * Redistributions in binary form must reproduce the above copyright #
+#       notice, this list of conditions and the following disclaimer in   #
+#       the documentation and/or other materials provided with the        #
+#       distribution.                                                     #
+#                                                                         #
+#     * Neither the name of UChicago Argonne, LLC, Argonne National       #
+#       Laboratory, ANL, the U.S. Government, nor the names of its        #
+#       contributors may be used to endorse or promote products derived   #
+#       from this software without specific prior written permission.     #
+#                                                                         #
+# THIS SOFTWARE IS PROVIDED BY UChicago Argonne, LLC AND CONTRIBUTORS     #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT       #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS       #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL UChicago     #
+# Argonne, LLC OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,        #
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,    #
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;        #
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER        #
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT      #
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN       #
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE         #
+# POSSIBILITY OF SUCH DAMAGE.                                             #
+# #########################################################################
+
+'''
+    Pipelined publication of the data sets of a directory. A reader thread reads
+    the data sets, a pool of render threads plots and encodes their images and
+    starts the uploads (see cloud.upload_async), and the calling thread publishes
+    the slides in the order of the files, in chunks of --batch-size slides.
+    Bounded queues between the stages keep the memory use constant.
+
+    With --workers the data sets are prepared by a pool of processes instead,
+    each returning the requests of its slide, see run_workers.
+'''
+import copy
+import queue
+import logging
+import threading
+import multiprocessing
+
+from concurrent.futures import ProcessPoolExecutor
+
+from tomolog_cli import log
+from tomolog_cli import cloud
+from tomolog_cli import metrics
+from tomolog_cli import standin
+from tomolog_cli import google_snippets
+
+__author__ = "Viktor Nikitin,  Francesco De Carlo"
+__copyright__ = "Copyright (c) 2022, UChicago Argonne, LLC."
+__docformat__ = 'restructuredtext en'
+__all__ = ['run',
+           'run_workers', ]
+
+
+def read(args, tomolog, top, fnames, read_queue, nworkers):
+    for index, fname in enumerate(fnames):
+        log.warning("  *** file %d/%d;  %s" % (index, len(fnames), fname))
+        # each data set has its own copy of args: reading and plotting set the slices and the contrast
+        file_args = copy.copy(args)
+        file_args.file_name = top + fname
+        file_args.count = 0
+        tl = None
+        data = None
+        with metrics.scan(fname):
+            try:
+                tl = tomolog(file_args)
+                data = tl.read_data()
+            except Exception as e:
+                log.error("Failed to read %s: %s — continuing batch", fname, e)
+        read_queue.put((index, fname, tl, data))
+    for k in range(nworkers):
+        read_queue.put(None)
+
+
+def render(read_queue, slide_queue):
+    while True:
+        item = read_queue.get()
+        if item is None:
+            slide_queue.put(None)
+            return
+        index, fname, tl, data = item
+        if data is not None:
+            with metrics.scan(fname):
+                try:
+                    tl.render_slide(*data)
+                except Exception as e:
+                    log.error("Failed to prepare %s: %s — continuing batch", fname, e)
+        # whatever was prepared is published, as in TomoLog.run_log
+        slide = tl.slide if tl is not None else None
+        slide_queue.put((index, tl, slide))
+
+
+def run(args, tomolog, top, fnames):
+    '''
+    Publish the files fnames of the directory top. tomolog creates the TomoLog
+    instance of args.beamline.
+    '''
+    nworkers = max(1, args.render_workers)
+    read_queue = queue.Queue(maxsize=max(1, args.read_ahead))
+    slide_queue = queue.Queue(maxsize=nworkers + max(1, args.read_ahead))
+    threads = [threading.Thread(target=read, name='reader',
+                                args=(args, tomolog, top, fnames, read_queue, nworkers), daemon=True)]
+    threads += [threading.Thread(target=render, name=f'render-{k}',
+                                 args=(read_queue, slide_queue), daemon=True) for k in range(nworkers)]
+    for thread in threads:
+        thread.start()
+
+    # commit the slides in the order of the files, slides done early wait in done
+    done = {}
+    slides = []
+    committed = []
+    next_index = 0
+    running = nworkers
+    while running:
+        item = slide_queue.get()
+        if item is None:
+            running -= 1
+            continue
+        done[item[0]] = item[1:]
+        while next_index in done:
+            tl, slide = done.pop(next_index)
+            next_index += 1
+            if tl is not None:
+                committed.append(tl)
+            if slide is not None:
+                slides.append(slide)
+            if len(slides) >= args.batch_size:
+                google_snippets.flush_slides(slides, args.batch_size)
+                slides = []
+                committed = _add_counts(args, committed)
+    google_snippets.flush_slides(slides, args.batch_size)
+    _add_counts(args, committed)
+    for thread in threads:
+        thread.join()
+
+
+def _add_counts(args, committed):
+    # uploads are counted on the copy of args of each data set, once its slide
+    # is flushed: the flush waits for the uploads still running
+    for tl in committed:
+        args.count += tl.args.count
+    return []
+
+
+def _init_worker(lfname, standin_url):
+    # workers are spawned: log to the log file of the parent and use its stand-in
+    log.setup_custom_logger(lfname)
+    if lfname is not None:
+        metrics.setup(lfname)
+    if standin_url is not None:
+        standin.attach(standin_url)
+
+
+def prepare(args, tomolog, top, fname):
+    '''
+    Prepare the slide of fname in a worker process. Return the presentation id,
+    page id and requests of the slide, the number of uploads and the stages run.
+    '''
+    file_args = copy.copy(args)
+    file_args.file_name = top + fname
+    file_args.count = 0
+    first = len(metrics.records())
+    tl = None
+    with metrics.scan(fname):
+        try:
+            tl = tomolog(file_args)
+            # the slide requests are only collected, the parent publishes them
+            tl.google_slide = google_snippets.DrySnippets()
+            tl.prepare_slide()
+        except Exception as e:
+            log.error("Failed to prepare %s: %s — continuing batch", fname, e)
+    payload = None
+    if tl is not None and tl.slide is not None:
+        # wait for the uploads, the futures stay in the worker
+        tl.slide.resolve()
+        payload = (tl.slide.presentation_id, tl.slide.page_id, tl.slide.requests)
+    return payload, file_args.count, metrics.records()[first:]
+
+
+def _log_file():
+    for handler in log.logger.handlers:
+        if isinstance(handler, logging.FileHandler):
+            return handler.baseFilename
+    return None
+
+
+def run_workers(args, tomolog, top, fnames):
+    '''
+    Prepare the slides of the files fnames of the directory top in --workers
+    processes and publish them in the order of the files, in chunks of
+    --batch-size slides. The insertion index of each slide is set when it is
+    published, see SlideBuilder.
+    '''
+    worker_args = copy.copy(args)
+    # the functions of __main__ cannot be imported by spawned workers: pass them
+    # the class of the beamline, not the tomolog function
+    if hasattr(worker_args, '_func'):
+        del worker_args._func
+    # each worker may start its own reader pool: split --nproc between the workers
+    # to keep the processes and shared memory segments at about --nproc
+    worker_args.nproc = max(1, args.nproc // args.workers)
+    beamline_log = type(tomolog(args))
+    standin_url = None
+    if args.standin:
+        standin_url = standin.url(args)
+    if args.cloud_service == 'local' and not args.dry_run:
+        # the images are served by this process, workers only write them in --local-dir.
+        # The urls of the embedded server end with the run and are not cached
+        if args.local_url is None:
+            worker_args.upload_cache_ttl = 0
+        worker_args.local_url = cloud.local_url(args)
+    log.info('Preparing the slides with %d worker processes' % args.workers)
+    # spawned, not forked: the parent runs threads (upload pool, stand-ins, servers)
+    with ProcessPoolExecutor(max_workers=args.workers, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=_init_worker, initargs=(_log_file(), standin_url)) as executor:
+        futures = [executor.submit(prepare, worker_args, beamline_log, top, fname) for fname in fnames]
+        slides = []
+        google_slide = None
+        for index, (fname, future) in enumerate(zip(fnames, futures)):
+            log.warning("  *** file %d/%d;  %s" % (index, len(fnames), fname))
+            try:
+                payload, count, records = future.result()
+            except Exception as e:
+                log.error("Worker failed to prepare %s: %s — continuing batch", fname, e)
+                continue
+            args.count += count
+            metrics.merge(records)
+            if payload is None:
+                continue
+            presentation_id, page_id, requests = payload
+            if google_slide is None:
+                google_slide = tomolog(args).connect()
+            slide = google_slide.slide_builder(presentation_id, page_id)
+            slide.requests = requests
+            slides.append(slide)
+            if len(slides) >= args.batch_size:
+                google_snippets.flush_slides(slides, args.batch_size)
+                slides = []
+        google_snippets.flush_slides(slides, args.batch_size)
@@ -0,0 +1,267 @@
+# #########################################################################
+# Copyright (c) 2022, UChicago Argonne, LLC. All rights reserved.         #
+#                                                                         #
+# Copyright 2022. UChicago Argonne, LLC. This software was produced       #
+# under U.S. Government contract DE-AC02-06CH11357 for Argonne National   #
+# Laboratory (ANL), which is operated by UChicago Argonne, LLC for the    #
+# U.S. Department of Energy. The U.S. Government has rights to use,       #
+# reproduce, and distribute this software.  NEITHER THE GOVERNMENT NOR    #
+# UChicago Argonne, LLC MAKES ANY WARRANTY, EXPRESS OR IMPLIED, OR        #
+# ASSUMES ANY LIABILITY FOR THE USE OF THIS SOFTWARE.  If software is     #
+# modified to produce derivative works, such modified software should     #
+# be clearly marked, so as not to confuse it with the version available   #
+# from ANL.                                                               #
+#                                                                         #
+# Additionally, redistribution and use in source and binary forms, with   #
+# or without modification, are permitted provided that the following      #
+# conditions are met:                                                     #
+#                                                                         #
+#     * Redistributions of source code must retain the above copyright    #
+#       notice, this list of conditions and the following disclaimer.     #
+#                                                                         #
+#     * Redistributions in binary form must reproduce the above copyright #
+#       notice, this list of conditions and the following disclaimer in   #
+#       the documentation and/or other materials provided with the        #
+#       distribution.                                                     #
+#                                                                         #
+#     * Neither the name of UChicago Argonne, LLC, Argonne National       #
+#       Laboratory, ANL, the U.S. Government, nor the names of its        #
+#       contributors may be used to endorse or promote products derived   #
+#       from this software without specific prior written permission.     #
+#                                                                         #
+# THIS SOFTWARE IS PROVIDED BY UChicago Argonne, LLC AND CONTRIBUTORS     #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT       #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS       #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL UChicago     #
+# Argonne, LLC OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,        #
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,    #
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;        #
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER        #
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT      #
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN       #
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE         #
+# POSSIBILITY OF SUCH DAMAGE.                                             #
+# #########################################################################
+
+'''
+    Local stand-ins for the google slides API and the imgur upload service.
+
+    The server implements the subset of the Slides v1 REST API used by
+    google_snippets.SlidesSnippets (presentations.get and presentations.batchUpdate
+    with createSlide, createShape, insertText, updateTextStyle,
+    createParagraphBullets and createImage) and the imgur upload endpoint used
+    by cloud.upload. It records request counts, payload sizes and latencies so
+    the publish pipeline can be measured without a google token or internet access.
+'''
+import re
+import copy
+import json
+import time
+import uuid
+import threading
+import http.server
+import urllib.request
+
+from email import policy
+from email.parser import BytesParser
+from collections import OrderedDict
+
+from tomolog_cli import log
+
+_server = None
+# url of the stand-in of another process, see attach
+_url = None
+_lock = threading.Lock()
+
+
+class Stats(object):
+    '''Request count, payload sizes and handling time per endpoint'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = OrderedDict()
+
+    def add(self, endpoint, bytes_in, bytes_out, seconds):
+        with self.lock:
+            s = self.endpoints.setdefault(endpoint, {'count': 0, 'bytes_in': 0, 'bytes_out': 0, 'seconds': 0.0})
+            s['count'] += 1
+            s['bytes_in'] += bytes_in
+            s['bytes_out'] += bytes_out
+            s['seconds'] += seconds
+
+    def report(self):
+        log.info('Stand-in requests:')
+        log.info('  {:<26} {:>6} {:>12} {:>12} {:>10}'.format('endpoint', 'count', 'bytes in', 'bytes out', 'mean ms'))
+        with self.lock:
+            for endpoint, s in self.endpoints.items():
+                log.info('  {:<26} {:>6} {:>12} {:>12} {:>10.1f}'.format(
+                    endpoint, s['count'], s['bytes_in'], s['bytes_out'], 1000 * s['seconds'] / s['count']))
+
+
+class BadRequest(Exception):
+    pass
+
+
+class StandinServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0):
+        super().__init__(('127.0.0.1', port), _Handler)
+        self.url = 'http://127.0.0.1:%d' % self.server_address[1]
+        # delay added to every request, in seconds, e.g. to mimic the SOCKS tunnel
+        self.latency = latency
+        self.stats = Stats()
+        self.lock = threading.Lock()
+        self.presentations = {}
+        self.images = {}
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name='standin', daemon=True).start()
+        log.info('Google slides and imgur stand-ins running at %s' % self.url)
+        return self
+
+    def slides(self, presentation_id):
+        return self.presentations.setdefault(presentation_id, [])
+
+    def batch_update(self, presentation_id, requests):
+        # validate and apply the requests on a copy: batchUpdate is atomic
+        slides = copy.deepcopy(self.slides(presentation_id))
+        elements = {e['objectId']: e for slide in slides for e in slide['elements']}
+        replies = []
+        for k, request in enumerate(requests):
+            (kind, params), = request.items()
+            if kind == 'createSlide':
+                index = params.get('insertionIndex', len(slides))
+                if not 0 <= index <= len(slides):
+                    raise BadRequest(f'Invalid requests[{k}].createSlide: insertion index {index} out of range')
+                slides.insert(index, {'objectId': params['objectId'], 'elements': []})
+                replies.append({'createSlide': {'objectId': params['objectId']}})
+            elif kind in ('createShape', 'createImage'):
+                page = params['elementProperties']['pageObjectId']
+                slide = next((s for s in slides if s['objectId'] == page), None)
+                if slide is None:
+                    raise BadRequest(f'Invalid requests[{k}].{kind}: page {page} not found')
+                element = {'objectId': params['objectId'], 'kind': kind, 'text': ''}
+                if kind == 'createImage':
+                    # like google, fetch the image when it is inserted
+                    try:
+                        with urllib.request.urlopen(params['url'], timeout=30) as response:
+                            element['bytes'] = len(response.read())
+                    except Exception:
+                        raise BadRequest(f'Invalid requests[{k}].createImage: There was a problem retrieving the image')
+                slide['elements'].append(element)
+                elements[element['objectId']] = element
+                replies.append({kind: {'objectId': params['objectId']}})
+            elif kind in ('insertText', 'updateTextStyle', 'createParagraphBullets'):
+                if params['objectId'] not in elements:
+                    raise BadRequest(f'Invalid requests[{k}].{kind}: object {params["objectId"]} not found')
+                if kind == 'insertText':
+                    elements[params['objectId']]['text'] += params['text']
+                replies.append({})
+            else:
+                raise BadRequest(f'Invalid requests[{k}]: {kind} is not supported by the stand-in')
+        self.presentations[presentation_id] = slides
+        return replies
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        log.debug('stand-in: ' + format % args)
+
+    def _body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def _reply(self, status, body, content_type='application/json'):
+        if isinstance(body, str):
+            body = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        return len(body)
+
+    def _error(self, status, message):
+        return self._reply(status, json.dumps({'error': {'code': status, 'message': message}}))
+
+    def _handle(self, method):
+        start = time.perf_counter()
+        server = self.server
+        body = self._body() if method == 'POST' else b''
+        path = self.path.split('?')[0]
+        if server.latency:
+            time.sleep(server.latency)
+        endpoint = 'unknown'
+        try:
+            m = re.fullmatch(r'/v1/presentations/([^/:]+)(:batchUpdate)?', path)
+            if m and method == 'GET' and not m.group(2):
+                endpoint = 'presentations.get'
+                with server.lock:
+                    slides = [{'objectId': s['objectId']} for s in server.slides(m.group(1))]
+                sent = self._reply(200, json.dumps({'presentationId': m.group(1), 'slides': slides}))
+            elif m and method == 'POST' and m.group(2):
+                endpoint = 'presentations.batchUpdate'
+                requests = json.loads(body).get('requests', [])
+                with server.lock:
+                    replies = server.batch_update(m.group(1), requests)
+                sent = self._reply(200, json.dumps({'presentationId': m.group(1), 'replies': replies}))
+            elif path == '/api/upload' and method == 'POST':
+                endpoint = 'imgur.upload'
+                message = BytesParser(policy=policy.default).parsebytes(
+                    b'Content-Type: ' + self.headers['Content-Type'].encode() + b'\r\n\r\n' + body)
+                data = next(part.get_payload(decode=True) for part in message.iter_parts()
+                            if part.get_param('name', header='content-disposition') == 'image')
+                name = f'{uuid.uuid4()}.jpg'
+                with server.lock:
+                    server.images[name] = data
+                # same reply format as the uploadimgur.com service
+                sent = self._reply(200, '{"link":"%s/images/%s"}' % (server.url, name))
+            elif path.startswith('/images/') and method == 'GET':
+                endpoint = 'imgur.image'
+                data = server.images.get(path[len('/images/'):])
+                if data is None:
+                    sent = self._error(404, 'image not found')
+                else:
+                    sent = self._reply(200, data, 'image/jpeg')
+            else:
+                sent = self._error(404, f'{method} {path} is not supported by the stand-in')
+        except BadRequest as e:
+            sent = self._error(400, str(e))
+        except (ValueError, KeyError, StopIteration) as e:
+            sent = self._error(400, f'malformed request: {e}')
+        server.stats.add(endpoint, len(body), sent, time.perf_counter() - start)
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+
+def attach(url):
+    '''Use the stand-in started by another process, e.g. by the parent of the batch workers'''
+    global _url
+    _url = url
+
+
+def url(args):
+    '''Url of the stand-in, started when needed'''
+    if _url is not None:
+        return _url
+    return start(args).url
+
+
+def start(args):
+    '''Start the stand-in server of this process, once, and return it'''
+    global _server
+    with _lock:
+        if _server is None:
+            _server = StandinServer(latency=args.standin_latency / 1000).start()
+    return _server
+
+
+def report():
+    if _server is not None:
+        _server.stats.report()
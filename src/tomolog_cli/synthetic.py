@@ -0,0 +1,233 @@
+# #########################################################################
+# Copyright (c) 2022, UChicago Argonne, LLC. All rights reserved.         #
+#                                                                         #
+# Copyright 2022. UChicago Argonne, LLC. This software was produced       #
+# under U.S. Government contract DE-AC02-06CH11357 for Argonne National   #
+# Laboratory (ANL), which is operated by UChicago Argonne, LLC for the    #
+# U.S. Department of Energy. The U.S. Government has rights to use,       #
+# reproduce, and distribute this software.  NEITHER THE GOVERNMENT NOR    #
+# UChicago Argonne, LLC MAKES ANY WARRANTY, EXPRESS OR IMPLIED, OR        #
+# ASSUMES ANY LIABILITY FOR THE USE OF THIS SOFTWARE.  If software is     #
+# modified to produce derivative works, such modified software should     #
+# be clearly marked, so as not to confuse it with the version available   #
+# from ANL.                                                               #
+#                                                                         #
+# Additionally, redistribution and use in source and binary forms, with   #
+# or without modification, are permitted provided that the following      #
+# conditions are met:                                                     #
+#                                                                         #
+#     * Redistributions of source code must retain the above copyright    #
+#       notice, this list of conditions and the following disclaimer.     #
+#                                                                         #
+#     * Redistributions in binary form must reproduce the above copyright #
+#       notice, this list of conditions and the following disclaimer in   #
+#       the documentation and/or other materials provided with the        #
+#       distribution.                                                     #
+#                                                                         #
+#     * Neither the name of UChicago Argonne, LLC, Argonne National       #
+#       Laboratory, ANL, the U.S. Government, nor the names of its        #
+#       contributors may be used to endorse or promote products derived   #
+#       from this software without specific prior written permission.     #
+#                                                                         #
+# THIS SOFTWARE IS PROVIDED BY UChicago Argonne, LLC AND CONTRIBUTORS     #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT       #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS       #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL UChicago     #
+# Argonne, LLC OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,        #
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,    #
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;        #
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER        #
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT      #
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN       #
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE         #
+# POSSIBILITY OF SUCH DAMAGE.                                             #
+# #########################################################################
+
+import os
+import h5py
+import tifffile
+import numpy as np
+
+from tomolog_cli import log
+
+__author__ = "Viktor Nikitin,  Francesco De Carlo"
+__copyright__ = "Copyright (c) 2022, UChicago Argonne, LLC."
+__docformat__ = 'restructuredtext en'
+__all__ = ['SIZES',
+           'LAYOUTS',
+           'write_raw',
+           'write_recon',
+           'write_dataset', ]
+
+# Width of the synthetic projections and reconstructions
+SIZES = {'1k': 1024, '2k': 2048, '4k': 4096}
+# Reconstruction layouts written by tomocupy: h5 is a virtual data set over per chunk files
+LAYOUTS = ('h5', 'h5nolinks', 'tiff')
+# Slices per source file of the h5 layout
+PART_HEIGHT = 32
+# Number of synthetic projections in the raw files
+NUM_PROJ = 4
+
+REC_LINE = 'tomocupy recon --file-name %s --rotation-axis %d --reconstruction-type full --save-format %s\n'
+
+# Meta data read by TomoLog and the beamline classes: (value, units)
+META = {
+    'measurement/sample/experiment/proposal':                          ('1000000', ''),
+    'measurement/sample/experimenter/name':                            ('Synthetic', ''),
+    'measurement/sample/experimenter/user_id':                         ('0', ''),
+    'measurement/instrument/detector/exposure_time':                   (0.1, 's'),
+    'measurement/instrument/detector/pixel_size':                      (3.45, 'um'),
+    'measurement/instrument/detection_system/objective/magnification': ('5x', ''),
+    'measurement/instrument/detection_system/objective/resolution':    (0.69, 'um'),
+    'measurement/instrument/detector/binning_x':                       (1, ''),
+    'measurement/instrument/name':                                     ('microCT', ''),
+    'measurement/instrument/monochromator/energy':                     (25.0, 'keV'),
+    'process/acquisition/flat_fields/sample/in_x':                     (0.0, 'mm'),
+    'process/acquisition/rotation/step':                               (0.12, 'deg'),
+    'process/acquisition/rotation/num_angles':                         (1500, ''),
+    'process/acquisition/rotation/start':                              (0.0, 'deg'),
+    'process/acquisition/start_date':                                  ('2022-01-01T00:00:00-0600', ''),
+}
+
+BEAMLINE_META = {
+    '2-bm': {
+        'measurement/instrument/source/beamline':                         ('2-BM-A', ''),
+        'measurement/instrument/sample_motor_stack/setup/hexapod_y':      (0.0, 'mm'),
+        'measurement/instrument/sample_motor_stack/setup/pitch':          (0.0, 'deg'),
+        'measurement/instrument/detector_motor_stack/setup/z':            (50.0, 'mm'),
+    },
+    '32-id': {
+        'measurement/instrument/source/beamline':                         ('32-ID-C', ''),
+        'measurement/instrument/phase_ring/setup/y':                      (0.0, 'mm'),
+    },
+    '7-bm': {
+        'measurement/instrument/source/beamline':                         ('7-BM-B', ''),
+        'measurement/instrument/sample_motor_stack/setup/y':              (0.0, 'mm'),
+        'measurement/instrument/sample_motor_stack/detector_distance':    (50.0, 'mm'),
+        'measurement/instrument/attenuator_1/description':                ('Filter', ''),
+        'measurement/instrument/attenuator_1/name':                       ('Al', ''),
+        'measurement/instrument/attenuator_1/thickness':                  (1.0, 'mm'),
+        'measurement/instrument/attenuator_2/setup/filter_unit_text':     ('Open', ''),
+        'measurement/instrument/attenuator_3/setup/filter_unit_text':     ('Open', ''),
+    },
+    'None': {
+        'measurement/instrument/source/beamline':                         ('None', ''),
+    },
+}
+
+
+def _write_meta(fid, items):
+    # stored as dxchange does: 1 element data sets with the units as attribute
+    for key, (value, units) in items.items():
+        if isinstance(value, str):
+            value = value.encode()
+        dset = fid.create_dataset(key, data=np.array([value]))
+        if units:
+            dset.attrs['units'] = units.encode()
+
+
+def _phantom(width):
+    # cylinder with a few inclusions and fixed noise, attenuation values as in a reconstruction
+    y, x = np.mgrid[-1:1:width*1j, -1:1:width*1j].astype('float32')
+    image = np.where(x**2+y**2 < 0.8**2, 2e-3, 0).astype('float32')
+    for cx, cy, r, value in ((0.3, 0.2, 0.15, 4e-3), (-0.35, -0.1, 0.2, 1e-3), (0.0, -0.45, 0.1, 6e-3)):
+        image[(x-cx)**2+(y-cy)**2 < r**2] = value
+    noise = np.random.default_rng(0).normal(0, 2e-4, (width, width)).astype('float32')
+    return image, noise
+
+
+def _slices(width, zs, ze):
+    image, noise = _phantom(width)
+    block = np.empty((ze-zs, width, width), dtype='float32')
+    for z in range(zs, ze):
+        block[z-zs] = image*(1+0.2*np.sin(z/16)) + np.roll(noise, z, axis=0)
+    return block
+
+
+def write_raw(fname, beamline, width, height, nproj=NUM_PROJ):
+    '''Write a raw data set with the meta data read by the beamline class'''
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    items = dict(META)
+    items.update(BEAMLINE_META.get(beamline, BEAMLINE_META['None']))
+    items['measurement/sample/file/full_name'] = (os.path.basename(fname), '')
+    items['measurement/instrument/detector/array_size_x'] = (width, '')
+    items['measurement/instrument/detector/array_size_y'] = (height, '')
+    image = _phantom(width)[0][:height]
+    proj = (np.exp(-200*image)*50000).astype('uint16')
+    with h5py.File(fname, 'w') as fid:
+        data = fid.create_dataset('exchange/data', (nproj, height, width), dtype='uint16', chunks=(1, height, width))
+        for k in range(nproj):
+            data[k] = np.roll(proj, k, axis=1)
+        fid.create_dataset('exchange/data_white', data=np.full((2, height, width), 50000, dtype='uint16'))
+        fid.create_dataset('exchange/data_dark', data=np.zeros((2, height, width), dtype='uint16'))
+        if beamline == '2-bm':
+            fid.create_dataset('exchange/web_camera_frame', data=np.zeros((480, 640), dtype='uint8'))
+        if beamline == '32-id':
+            fid.create_dataset('exchange/data2', data=proj[::4, ::4])
+        _write_meta(fid, items)
+
+
+def write_recon(fname, layout, width, height, chunks=None):
+    '''
+    Write the reconstruction of the raw file fname as tomocupy does for the layouts:
+    h5, a virtual data set over files of PART_HEIGHT slices, h5nolinks, a single file
+    (contiguous unless chunks is set), and tiff, a folder of recon_%05d.tiff slices.
+    '''
+    basename = os.path.basename(fname)[:-3]
+    rec_dir = os.path.dirname(fname) + '_rec'
+    os.makedirs(rec_dir, exist_ok=True)
+    line = REC_LINE % (fname, width//2, layout)
+    if layout == 'tiff':
+        top = os.path.join(rec_dir, basename+'_rec')
+        os.makedirs(top, exist_ok=True)
+        for zs in range(0, height, PART_HEIGHT):
+            block = _slices(width, zs, min(zs+PART_HEIGHT, height))
+            for k in range(len(block)):
+                tifffile.imwrite(os.path.join(top, 'recon_%05d.tiff' % (zs+k)), block[k])
+        with open(os.path.join(top, 'rec_line.txt'), 'w') as fid:
+            fid.write(line)
+        return
+    h5_fname = os.path.join(rec_dir, basename+'_rec.h5')
+    if layout == 'h5':
+        parts = basename+'_rec_parts'
+        os.makedirs(os.path.join(rec_dir, parts), exist_ok=True)
+        vlayout = h5py.VirtualLayout((height, width, width), dtype='float32')
+        for zs in range(0, height, PART_HEIGHT):
+            block = _slices(width, zs, min(zs+PART_HEIGHT, height))
+            # source paths are relative to the virtual data set file
+            part = os.path.join(parts, 'recon_%05d.h5' % zs)
+            with h5py.File(os.path.join(rec_dir, part), 'w') as fid:
+                fid.create_dataset('exchange/data', data=block)
+            vlayout[zs:zs+len(block)] = h5py.VirtualSource(part, 'exchange/data', shape=block.shape)
+        with h5py.File(h5_fname, 'w') as fid:
+            data = fid.create_virtual_dataset('exchange/data', vlayout, fillvalue=np.nan)
+            data.attrs['command'] = line.strip()
+    else:
+        with h5py.File(h5_fname, 'w') as fid:
+            data = fid.create_dataset('exchange/data', (height, width, width), dtype='float32', chunks=chunks)
+            for zs in range(0, height, PART_HEIGHT):
+                ze = min(zs+PART_HEIGHT, height)
+                data[zs:ze] = _slices(width, zs, ze)
+            data.attrs['command'] = line.strip()
+    with open(os.path.join(rec_dir, basename+'_rec_line.txt'), 'w') as fid:
+        fid.write(line)
+
+
+def write_dataset(top, beamline, size, height, layout, nscans=1):
+    '''
+    Write nscans raw files and their reconstructions in top/<beamline>_<layout>_<size>_<height>/data
+    and data_rec, unless already there, and return the raw file names
+    '''
+    width = SIZES[size]
+    height = min(height, width)
+    data_dir = os.path.join(top, f'{beamline}_{layout}_{size}_{height}', 'data')
+    fnames = []
+    for k in range(nscans):
+        fname = os.path.join(data_dir, 'scan_%04d.h5' % k)
+        if not os.path.exists(fname):
+            log.info('Writing synthetic %s %s data set: %s' % (size, layout, fname))
+            write_recon(fname, layout, width, height)
+            # the raw file is written last, it marks a complete data set
+            write_raw(fname, beamline, width, height)
+        fnames.append(fname)
+    return fnames
@@ -49,7 +49,7 @@ import pathlib
 import datetime
 import yaml
 import h5py
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 import numpy as np
 
 from matplotlib_scalebar.scalebar import ScaleBar
@@ -63,13 +63,15 @@ from tomolog_cli import log
 from tomolog_cli import auth
 from tomolog_cli import utils
 from tomolog_cli import cloud
+from tomolog_cli import encode
+from tomolog_cli import metrics
 
 __author__ = "Viktor Nikitin,  Francesco De Carlo"
 __copyright__ = "Copyright (c) 2022, UChicago Argonne, LLC."
 __docformat__ = 'restructuredtext en'
 __all__ = ['TomoLog', ]
 
-# Temporary local files to be uploaded to the url service. Google API retrieves images by url before publishing on slides
+# Names of the images uploaded to the url service. Images are rendered in memory. Google API retrieves images by url before publishing on slides
 FILE_NAME_PROJ  = 'projection'
 FILE_NAME_RECON = 'reconstruction'
 
@@ -84,9 +86,15 @@ class TomoLog():
     '''
 
     def __init__(self, args):
-        self.google_slide = auth.google_slide(args, GOOGLE_TOKEN)
+        # connection to google, made when the first slide is created
+        self.google_slide = None
 
         self.args = args
+        self.slide = None
+        self.double_fov = False
+        # bytes of the images as rendered, lossless, and as encoded for upload
+        self.bytes_rendered = 0
+        self.bytes_encoded = 0
 
         self.file_name_proj0 = FILE_NAME_PROJ  + '.jpg'
         self.file_name_recon = FILE_NAME_RECON + '.jpg'
@@ -136,8 +144,8 @@ class TomoLog():
             "Projection size: {int(self.meta[self.width_key][0])} x {int(self.meta[self.height_key][0])}")
         if (self.args.beamline == "None"):
             descr = descr[:-1]
-            self.google_slide.create_textbox_with_bullets(
-                presentation_id, page_id, descr, 240, 120, 0, 18, 8, 0)
+            self.slide.create_textbox_with_bullets(
+                descr, 240, 120, 0, 18, 8, 0)
         
         return descr
 
@@ -145,8 +153,8 @@ class TomoLog():
         note = self.args.note
         if self.args.note != None:
             log.info('Publish note')
-            self.google_slide.create_textbox_with_text(
-                presentation_id, page_id, note, 300,100, 10, 320, 10, 0
+            self.slide.create_textbox_with_text(
+                note, 300,100, 10, 320, 10, 0
                 )
         else:
             pass
@@ -224,6 +232,47 @@ class TomoLog():
         return line
 
     def run_log(self):
+        with metrics.scan(os.path.basename(self.args.file_name)):
+            try:
+                self.prepare_slide()
+            finally:
+                # publish whatever was prepared, also when a step failed
+                if self.slide is not None:
+                    self.slide.flush()
+
+    def prepare_slide(self):
+        '''
+        Read the data set, render and upload its images and collect the requests
+        creating its slide. The slide is published when the builder is flushed.
+        '''
+        proj, recon = self.read_data()
+        return self.render_slide(proj, recon)
+
+    def read_data(self):
+        '''Read the meta data, the projection and the reconstruction of the data set'''
+        with metrics.stage('read meta'):
+            self.read_meta()
+        with metrics.stage('read raw'):
+            proj = self.read_raw()
+            metrics.add('bytes_read', sum(p.nbytes for p in proj))
+        with metrics.stage('read recon'):
+            recon = self.read_recon()
+        return proj, recon
+
+    def render_slide(self, proj, recon):
+        '''Plot the images of the data set read by read_data, upload them and collect the requests creating its slide'''
+        presentation_id, page_id = self.init_slide()
+        self.save_history(self.args.presentation_url)
+        self.publish_descr(presentation_id, page_id)
+        self.publish_note(presentation_id, page_id)
+        self.publish_proj(presentation_id, page_id, proj)
+        self.publish_recon(presentation_id, page_id, recon)
+        # bytes_rendered counts the intermediate PNG renders, which are never uploaded
+        log.info('Slide images encoded to %d kB, from %d kB of PNG renders' % (
+            self.bytes_encoded // 1024, self.bytes_rendered // 1024))
+        return self.slide
+
+    def read_meta(self):
         # read meta, calculate resolutions
         mp = meta.read_meta.Hdf5MetadataReader(self.args.file_name)
         self.meta = mp.readMetadata()
@@ -250,20 +299,14 @@ class TomoLog():
 
         self.setup_resolutions()
 
-        presentation_id, page_id = self.init_slide()
-        self.save_history(self.args.presentation_url)
-        self.publish_descr(presentation_id, page_id)
-        self.publish_note(presentation_id, page_id)
-        proj = self.read_raw()
-        self.publish_proj(presentation_id, page_id, proj)
-        recon = self.read_recon()
-        #print(recon)
-        self.publish_recon(presentation_id, page_id, recon)
-        cloud.cleanup(self.args)
-
     def setup_resolutions(self):
         pass
 
+    def connect(self):
+        if self.google_slide is None:
+            self.google_slide = auth.google_slide(self.args, GOOGLE_TOKEN)
+        return self.google_slide
+
     def init_slide(self):
         # create a slide and publish file name
         file_name = os.path.basename(self.args.file_name)
@@ -273,14 +316,19 @@ class TomoLog():
             log.error(
                 "Set --presentation-url to point to a valid Google slide location")
             exit()
-        # Create a new Google slide
+        # Create a new Google slide. Requests are accumulated by the slide builder
+        # and sent to google with a single batchUpdate call in run_log
         page_id = str(uuid.uuid4())
-        self.google_slide.create_slide(presentation_id, page_id)
-        self.google_slide.create_textbox_with_text(presentation_id, page_id, os.path.basename(
+        self.slide = self.connect().slide_builder(presentation_id, page_id)
+        self.slide.create_slide()
+        self.slide.create_textbox_with_text(os.path.basename(
             self.args.file_name)[:-3], 400, 50, 0, 0, 13, 1)
         return presentation_id, page_id
 
     def save_history(self, presentation_url):
+        if self.args.dry_run or self.args.standin:
+            log.info('Slide not published on google, history not saved')
+            return
         history_file = pathlib.Path.home() / '.tomolog'
         entry = {
             'date':             datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
@@ -291,17 +339,19 @@ class TomoLog():
             'beamline':         str(self.meta.get(self.beamline_key,  [None])[0]),
             'file':             str(self.args.file_name),
         }
-        history = []
-        if history_file.exists():
-            try:
-                with open(history_file) as f:
-                    history = yaml.safe_load(f) or []
-            except yaml.YAMLError:
-                log.warning('Could not parse existing %s, starting fresh' % history_file)
-                history = []
-        history.append(entry)
-        with open(history_file, 'w') as f:
-            yaml.safe_dump(history, f, default_flow_style=False, allow_unicode=True)
+        # slides of a batch are prepared concurrently
+        with utils.file_lock(str(history_file) + '.lock'):
+            history = []
+            if history_file.exists():
+                try:
+                    with open(history_file) as f:
+                        history = yaml.safe_load(f) or []
+                except yaml.YAMLError:
+                    log.warning('Could not parse existing %s, starting fresh' % history_file)
+                    history = []
+            history.append(entry)
+            with open(history_file, 'w') as f:
+                yaml.safe_dump(history, f, default_flow_style=False, allow_unicode=True)
         log.info('History saved to %s' % history_file)
 
     def read_meta_item(self, template):
@@ -350,34 +400,20 @@ class TomoLog():
                     else:
                         binning_rec = width // w
 
-                    # Stream through z in bounded-memory chunks and extract
-                    # all three cross-sections in one pass. The old code did
-                    # data[:, :, idx] / data[:, idy] / data[idz] as three
-                    # separate slices; each cross-cut the z-primary chunking
-                    # and forced h5py to rescan the whole file, taking >10 min
-                    # on bin1 volumes.
-                    dtype = data.dtype
-                    idx, idy, idz = self.args.idx, self.args.idy, self.args.idz
-                    bytes_per_slice = int(w) * int(w2) * dtype.itemsize
-                    chunk_z = max(1, (256 * 1024 * 1024) // bytes_per_slice)
-                    if data.chunks is not None:
-                        chunk_z = max(chunk_z, data.chunks[0])
-                    x = np.empty((h, w), dtype=dtype)
-                    y = np.empty((h, w2), dtype=dtype)
-                    z = None
-                    for zs in range(0, h, chunk_z):
-                        ze = min(zs + chunk_z, h)
-                        block = data[zs:ze, :, :]
-                        x[zs:ze] = block[:, :, idx]
-                        y[zs:ze] = block[:, idy, :]
-                        if zs <= idz < ze:
-                            z = block[idz - zs].copy()
-                    if z is None:
-                        z = data[idz]
+                    if data.is_virtual:
+                        # tomocupy h5 output: read the source files of the z ranges directly
+                        x, y, z = utils.read_virtual_orthoslices(fname, data, self.args.idx, self.args.idy, self.args.idz, self.args.nproc)
+                    else:
+                        # read only the chunks intersecting the slices, or the
+                        # volume once in z blocks when every chunk intersects them
+                        x, y, z = utils.read_orthoslices(data, self.args.idx, self.args.idy, self.args.idz, self.args.nproc)
                 recon = [x, y, z]
                 self.binning_rec = binning_rec
-            except FileNotFoundError:
-                log.error(f'Reconstruction h5 file missing: {fname}')
+            except FileNotFoundError as e:
+                log.error(f'Reconstruction h5 file missing: {e.filename or fname}')
+                log.warning('Skipping reconstruction')
+            except ValueError as e:
+                log.error(e)
                 log.warning('Skipping reconstruction')
             except KeyError:
                 log.error(f'/exchange/data not found in {fname} (h5sino is not supported for slicing)')
@@ -423,14 +459,17 @@ class TomoLog():
 
                 nthreads = 8
                 threads = []
+                nbytes = []
                 lchunk = int(np.ceil((z_end-z_start)/nthreads))
                 lchunk = np.minimum(lchunk, np.int32(z_end-z_start-np.arange(nthreads)*lchunk))  # chunk sizes
                 for k in range(nthreads):
-                    read_proc = Thread(target=utils.read_tiff_part, args=(self.args, f'{rec_dir}/{basename}_rec/{rec_prefix}', x, y, z_start, k*lchunk[0], lchunk[k]))
+                    read_proc = Thread(target=utils.read_tiff_part, args=(self.args, f'{rec_dir}/{basename}_rec/{rec_prefix}', x, y, z_start, k*lchunk[0], lchunk[k], nbytes))
                     threads.append(read_proc)
                     read_proc.start()
                 for th in threads:
                     th.join()
+                # the reading threads only read the rows and columns of the slices
+                metrics.add('bytes_read', z.nbytes + sum(nbytes))
                 
                 recon = [x, y, z]
 
@@ -447,6 +486,7 @@ class TomoLog():
         return recon
 
 
+    @metrics.timed('plot')
     def plot_projection(self, proj, fname):
         log.info('Plot microCT projection')
         # auto-adjust colorbar values according to a histogram
@@ -455,7 +495,7 @@ class TomoLog():
         proj[proj < mmin] = mmin
 
         # plot
-        fig = plt.figure(constrained_layout=True, figsize=(6, 4))
+        fig = Figure(constrained_layout=True, figsize=(6, 4))
         ax = fig.add_subplot()
         im = ax.imshow(proj, cmap='gray')
         # Create scale bar
@@ -463,14 +503,15 @@ class TomoLog():
         ax.add_artist(scalebar)
         divider = make_axes_locatable(ax)
         cax = divider.append_axes("right", size="5%", pad=0.1)
-        plt.colorbar(im, cax=cax, format='%.1e')
-        plt.savefig(fname, bbox_inches='tight', pad_inches=0, dpi=300)
-        plt.cla()
-        plt.close(fig)
+        fig.colorbar(im, cax=cax, format='%.1e')
+        image = utils.image_buffer(fname)
+        fig.savefig(image, format='png', bbox_inches='tight', pad_inches=0, dpi=300)
+        return image
 
+    @metrics.timed('plot')
     def plot_recon(self, recon, fname):
         log.info('Plot reconstruction')
-        fig = plt.figure(constrained_layout=True, figsize=(14, 12))
+        fig = Figure(constrained_layout=True, figsize=(14, 12))
         grid = fig.add_gridspec(3, 3, height_ratios=[1, 1, 1])
         slices = ['x', 'y', 'z']
         # autoadjust colorbar values according to a histogram
@@ -503,36 +544,41 @@ class TomoLog():
                 ax.add_artist(scalebar)
                 divider = make_axes_locatable(ax)
                 cax = divider.append_axes("right", size="5%", pad=0.1)
-                cb = plt.colorbar(im, cax=cax)
+                cb = fig.colorbar(im, cax=cax)
                 if j<2:
                     cb.remove()
                 if j==0:
                     ax.set_ylabel(f'slice {slices[k]}={sl[k]}', fontsize=18)
-        plt.savefig(fname, bbox_inches='tight', pad_inches=0, dpi=150)
-        plt.cla()
-        plt.close(fig)
+        image = utils.image_buffer(fname)
+        fig.savefig(image, format='png', bbox_inches='tight', pad_inches=0, dpi=150)
+        return image
+
+    def publish_image(self, image, magnitude_width, magnitude_height, posx, posy):
+        # encode the rendered image for its size on the slide and upload it in the background
+        encoded = encode.fit_image(image, magnitude_width, magnitude_height,
+                                   self.args.image_scale, int(self.args.image_budget * 1024))
+        self.bytes_rendered += len(image.getvalue())
+        self.bytes_encoded += len(encoded.getvalue())
+        self.slide.create_image(
+            cloud.upload_async(self.args, encoded), magnitude_width, magnitude_height, posx, posy)
 
     def publish_proj(self, presentation_id, page_id, proj, resolution=1):
-        self.google_slide.create_textbox_with_text(
-            presentation_id, page_id, 'Projection', 90, 20, 50, 163, 8, 0)        
-        self.plot_projection(proj[0], self.file_name_proj0)
-        proj_url = cloud.upload(self.args, self.file_name_proj0)
+        self.slide.create_textbox_with_text(
+            'Projection', 90, 20, 50, 163, 8, 0)        
+        proj0 = self.plot_projection(proj[0], self.file_name_proj0)
         log.info('Publish projection')
-        self.google_slide.create_image(
-            presentation_id, page_id, proj_url, 150, 150, 10, 157)
+        self.publish_image(proj0, 150, 150, 10, 157)
 
     def publish_recon(self, presentation_id, page_id, recon):
         if len(recon) == 3:
             # publish reconstructions
-            self.google_slide.create_textbox_with_text(
-                presentation_id, page_id, f'Reconstruction                                   Zoom {self.args.zoom}', 430, 14, 270, 2, 10, 0)
-            self.plot_recon(recon, self.file_name_recon)
-            recon_url = cloud.upload(self.args, self.file_name_recon)
+            self.slide.create_textbox_with_text(
+                f'Reconstruction                                   Zoom {self.args.zoom}', 430, 14, 270, 2, 10, 0)
+            rec = self.plot_recon(recon, self.file_name_recon)
             log.info('Publish reconstruction')
-            self.google_slide.create_image(
-                presentation_id, page_id, recon_url, 470, 336, 230, 21)
+            self.publish_image(rec, 470, 336, 230, 21)
 
             rec_line = self.read_rec_line()
-            self.google_slide.create_textbox_with_text(
-                presentation_id, page_id, rec_line, 710, 43, 5, 360, 6, 0)
+            self.slide.create_textbox_with_text(
+                rec_line, 710, 43, 5, 360, 6, 0)
 
@@ -47,9 +47,7 @@ import os
 import meta
 import h5py
 import numpy as np
-import matplotlib
-matplotlib.use('Agg')  # use non-GUI backend before importing pyplot
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 
 from matplotlib_scalebar.scalebar import ScaleBar
 from mpl_toolkits.axes_grid1 import make_axes_locatable
@@ -58,8 +56,8 @@ import requests
 
 from tomolog_cli import utils
 from tomolog_cli import log
+from tomolog_cli import metrics
 from tomolog_cli import TomoLog
-from tomolog_cli import cloud
 
 __author__ = "Viktor Nikitin,  Francesco De Carlo"
 __copyright__ = "Copyright (c) 2022, UChicago Argonne, LLC."
@@ -120,8 +118,8 @@ class TomoLog2BM(TomoLog):
                 pitch_angle_units = self.read_meta_item("{self.meta[self.sample_pitch_angle_key][1]}")
                 descr += "Pitch angle: " + str(pitch_angle) + pitch_angle_units
         descr = descr[:-1]
-        self.google_slide.create_textbox_with_bullets(
-            presentation_id, page_id, descr, 240, 120, 0, 18, 8, 0)
+        self.slide.create_textbox_with_bullets(
+            descr, 240, 120, 0, 18, 8, 0)
 
     def read_raw(self):
         log.info('Reading microCT projection')
@@ -144,23 +142,23 @@ class TomoLog2BM(TomoLog):
 
     def publish_proj(self, presentation_id, page_id, proj):
         # 2-BM datasets may include both microCT data and a web camera image
-        self.google_slide.create_textbox_with_text(
-            presentation_id, page_id, 'Micro-CT projection', 90, 20, 10, 167, 8, 0)
-        self.plot_projection(proj[0], self.file_name_proj0)
-        proj_url = cloud.upload(self.args, self.file_name_proj0)
+        self.slide.create_textbox_with_text(
+            'Micro-CT projection', 90, 20, 10, 167, 8, 0)
+        proj0 = self.plot_projection(proj[0], self.file_name_proj0)
         log.info('Publish microCT projection')
-        self.google_slide.create_image(
-            presentation_id, page_id, proj_url, 170, 170, 0, 190)
+        self.publish_image(proj0, 170, 170, 0, 190)
         if len(proj) > 1:
-            self.google_slide.create_textbox_with_text(
-                presentation_id, page_id, 'Frame from the IP camera in the hutch', 160, 20, 10, 290, 8, 0)
+            self.slide.create_textbox_with_text(
+                'Frame from the IP camera in the hutch', 160, 20, 10, 290, 8, 0)
             log.info('Plotting web camera image')
-            plt.imshow(np.fliplr(proj[1].reshape(-1,3)).reshape(proj[1].shape))
-            plt.axis('off')
-            plt.savefig(self.file_name_webcam,dpi=300)
-            webcam_url = cloud.upload(self.args, self.file_name_webcam)
+            with metrics.stage('plot'):
+                fig = Figure()
+                ax = fig.add_subplot()
+                ax.imshow(np.fliplr(proj[1].reshape(-1,3)).reshape(proj[1].shape))
+                ax.axis('off')
+                webcam = utils.image_buffer(self.file_name_webcam)
+                fig.savefig(webcam, format='png', dpi=300)
             log.info('Publish web camera image')
-            self.google_slide.create_image(
-                presentation_id, page_id, webcam_url, 170, 170, 0, 270)
+            self.publish_image(webcam, 170, 170, 0, 270)
         else:
             log.warning('No frame from the IP camera')
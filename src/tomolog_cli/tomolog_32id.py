@@ -49,17 +49,15 @@ import pathlib
 import meta
 import h5py
 import numpy as np
-import matplotlib
-matplotlib.use('Agg')  # use non-GUI backend before importing pyplot
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 from matplotlib_scalebar.scalebar import ScaleBar
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 from ast import literal_eval
 
 from tomolog_cli import utils
 from tomolog_cli import log
+from tomolog_cli import metrics
 from tomolog_cli import TomoLog
-from tomolog_cli import cloud
 
 __author__ = "Viktor Nikitin,  Francesco De Carlo"
 __copyright__ = "Copyright (c) 2022, UChicago Argonne, LLC."
@@ -96,8 +94,8 @@ class TomoLog32ID(TomoLog):
             "Scan energy: {self.meta[self.energy_key][0]} {self.meta[self.energy_key][1]}")
 
         descr = descr[:-1]
-        self.google_slide.create_textbox_with_bullets(
-            presentation_id, page_id, descr, 240, 120, 0, 18, 8, 0)
+        self.slide.create_textbox_with_bullets(
+            descr, 240, 120, 0, 18, 8, 0)
 
     def setup_resolutions(self):
         self.nct_resolution = float(self.meta[self.resolution_key][0])/1000
@@ -147,6 +145,7 @@ class TomoLog32ID(TomoLog):
                     x = data[:,:,self.args.idx]
                     y = data[:,self.args.idy]
                     z = data[self.args.idz]
+                    metrics.add('bytes_read', x.nbytes + y.nbytes + z.nbytes)
             else:                
                 basename = os.path.basename(self.args.file_name)[:-3]
                 dirname = os.path.dirname(self.args.file_name)
@@ -196,10 +195,9 @@ class TomoLog32ID(TomoLog):
                 x = np.zeros((h, w), dtype='float32')
 
                 for j in range(z_start, z_end):
-                    zz = utils.read_tiff(
-                        f'{dirname}_rec/{basename}_rec/{rec_prefix}_{j:05}.tiff')
-                    y[j-z_start, :] = zz[self.args.idy]
-                    x[j-z_start, :] = zz[:, self.args.idx]
+                    x[j-z_start, :], y[j-z_start, :], nbytes = utils.read_tiff_lines(
+                        f'{dirname}_rec/{basename}_rec/{rec_prefix}_{j:05}.tiff', self.args.idx, self.args.idy)
+                    metrics.add('bytes_read', nbytes)
             
             # check if inversion is needed for the phase-contrast imaging at 32id
             phase_ring_y = float(self.meta[self.phase_ring_setup_y_key][0])
@@ -220,6 +218,7 @@ class TomoLog32ID(TomoLog):
 
         return recon
 
+    @metrics.timed('plot')
     def plot_projection(self, proj, fname,scalebar='nano'):
         log.info('Plot projection')
         # auto-adjust colorbar values according to a histogram
@@ -228,7 +227,7 @@ class TomoLog32ID(TomoLog):
         proj[proj < mmin] = mmin
 
         # plot
-        fig = plt.figure(constrained_layout=True, figsize=(6, 4))
+        fig = Figure(constrained_layout=True, figsize=(6, 4))
         ax = fig.add_subplot()
         im = ax.imshow(proj, cmap='gray')
         # Create scale bar
@@ -239,16 +238,16 @@ class TomoLog32ID(TomoLog):
         ax.add_artist(scalebar)
         divider = make_axes_locatable(ax)
         cax = divider.append_axes("right", size="5%", pad=0.1)
-        plt.colorbar(im, cax=cax)
-        # plt.show()
+        fig.colorbar(im, cax=cax)
         # save
-        plt.savefig(fname, bbox_inches='tight', pad_inches=0, dpi=300)
-        plt.cla()
-        plt.close(fig)
+        image = utils.image_buffer(fname)
+        fig.savefig(image, format='png', bbox_inches='tight', pad_inches=0, dpi=300)
+        return image
 
+    @metrics.timed('plot')
     def plot_recon(self, recon, fname):
         log.info('Plot reconstruction')
-        fig = plt.figure(constrained_layout=True, figsize=(14, 12))
+        fig = Figure(constrained_layout=True, figsize=(14, 12))
         grid = fig.add_gridspec(3, 3, height_ratios=[1, 1, 1])
         slices = ['x', 'y', 'z']
 
@@ -283,46 +282,40 @@ class TomoLog32ID(TomoLog):
                 ax.add_artist(scalebar)
                 divider = make_axes_locatable(ax)
                 cax = divider.append_axes("right", size="5%", pad=0.1)
-                cb = plt.colorbar(im, cax=cax)
+                cb = fig.colorbar(im, cax=cax)
                 if j < 2:
                     cb.remove()
                 if j == 0:
                     ax.set_ylabel(f'slice {slices[k]}={sl[k]}', fontsize=18)
-        plt.savefig(fname, bbox_inches='tight', pad_inches=0, dpi=150)
-        plt.cla()
-        plt.close(fig)
+        image = utils.image_buffer(fname)
+        fig.savefig(image, format='png', bbox_inches='tight', pad_inches=0, dpi=150)
+        return image
 
     def publish_proj(self, presentation_id, page_id, proj):
         # 32-id datasets may include both nanoCT and microCT data as proj[0] and proj[1] respectively
-        self.google_slide.create_textbox_with_text(
-            presentation_id, page_id, 'Nano-CT projection', 90, 20, 10, 155, 8, 0)
-        self.plot_projection(proj[0], self.file_name_proj0)
-        proj_url = cloud.upload(self.args, self.file_name_proj0)
+        self.slide.create_textbox_with_text(
+            'Nano-CT projection', 90, 20, 10, 155, 8, 0)
+        proj0 = self.plot_projection(proj[0], self.file_name_proj0)
         log.info('Publish nanoCT projection')
-        self.google_slide.create_image(
-            presentation_id, page_id, proj_url, 170, 170, 0, 145)
+        self.publish_image(proj0, 170, 170, 0, 145)
         if len(proj) > 1:
-            self.google_slide.create_textbox_with_text(
-                presentation_id, page_id, 'Micro-CT projection', 90, 20, 10, 280, 8, 0)
-            self.plot_projection(proj[1], self.file_name_proj1, scalebar='micro')
-            proj_url = cloud.upload(self.args, self.file_name_proj1)
+            self.slide.create_textbox_with_text(
+                'Micro-CT projection', 90, 20, 10, 280, 8, 0)
+            proj1 = self.plot_projection(proj[1], self.file_name_proj1, scalebar='micro')
             log.info('Publish microCT projection')
-            self.google_slide.create_image(
-                presentation_id, page_id, proj_url, 170, 170, 0, 270)
+            self.publish_image(proj1, 170, 170, 0, 270)
         else:
             log.warning('No microCT data available')
 
     def publish_recon(self, presentation_id, page_id, recon):
         if len(recon) == 3:
             # publish reconstructions
-            self.google_slide.create_textbox_with_text(
-                presentation_id, page_id, f'Reconstruction                                   Zoom {self.args.zoom}', 430, 14, 270, 2, 10, 0)
-            self.plot_recon(recon, self.file_name_recon)
-            recon_url = cloud.upload(self.args, self.file_name_recon)
+            self.slide.create_textbox_with_text(
+                f'Reconstruction                                   Zoom {self.args.zoom}', 430, 14, 270, 2, 10, 0)
+            rec = self.plot_recon(recon, self.file_name_recon)
             log.info('Publish reconstruction')
-            self.google_slide.create_image(
-                presentation_id, page_id, recon_url, 470, 336, 230, 21)
+            self.publish_image(rec, 470, 336, 230, 21)
 
             rec_line = self.read_rec_line()
-            self.google_slide.create_textbox_with_text(
-                presentation_id, page_id, rec_line, 710, 43, 5, 360, 6, 0)
+            self.slide.create_textbox_with_text(
+                rec_line, 710, 43, 5, 360, 6, 0)
@@ -60,7 +60,6 @@ import meta
 from tomolog_cli import utils
 from tomolog_cli import log
 from tomolog_cli import TomoLog
-from tomolog_cli import cloud
 
 __author__ = "Viktor Nikitin,  Francesco De Carlo"
 __copyright__ = "Copyright (c) 2022, UChicago Argonne, LLC."
@@ -105,8 +104,8 @@ class TomoLog7BM(TomoLog):
             "Propagation dist.: {self.meta[self.propogation_distance_key][0]:.02f} {self.meta[self.propogation_distance_key][1]}")
 
         descr = descr[:-1]
-        self.google_slide.create_textbox_with_bullets(
-            presentation_id, page_id, descr, 240, 120, 0, 18, 8, 0)
+        self.slide.create_textbox_with_bullets(
+            descr, 240, 120, 0, 18, 8, 0)
 
     def read_raw(self):
         log.info('Reading microCT projection')
@@ -124,12 +123,10 @@ class TomoLog7BM(TomoLog):
 
     def publish_proj(self, presentation_id, page_id, proj):
         # 7-bm datasets include only microCT data
-        self.google_slide.create_textbox_with_text(
-            presentation_id, page_id, 'Micro-CT projection', 90, 20, 10, 155, 8, 0)
-        self.plot_projection(proj[0], self.file_name_proj0)
-        proj_url = cloud.upload(self.args, self.file_name_proj0)
+        self.slide.create_textbox_with_text(
+            'Micro-CT projection', 90, 20, 10, 155, 8, 0)
+        proj0 = self.plot_projection(proj[0], self.file_name_proj0)
         log.info('Publish microCT projection')
-        self.google_slide.create_image(
-            presentation_id, page_id, proj_url, 170, 170, 0, 145)
+        self.publish_image(proj0, 170, 170, 0, 145)
 
 
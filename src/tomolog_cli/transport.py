@@ -0,0 +1,105 @@
+# #########################################################################
+# Copyright (c) 2022, UChicago Argonne, LLC. All rights reserved.         #
+#                                                                         #
+# Copyright 2022. UChicago Argonne, LLC. This software was produced       #
+# under U.S. Government contract DE-AC02-06CH11357 for Argonne National   #
+# Laboratory (ANL), which is operated by UChicago Argonne, LLC for the    #
+# U.S. Department of Energy. The U.S. Government has rights to use,       #
+# reproduce, and distribute this software.  NEITHER THE GOVERNMENT NOR    #
+# UChicago Argonne, LLC MAKES ANY WARRANTY, EXPRESS OR IMPLIED, OR        #
+# ASSUMES ANY LIABILITY FOR THE USE OF THIS SOFTWARE.  If software is     #
+# modified to produce derivative works, such modified software should     #
+# be clearly marked, so as not to confuse it with the version available   #
+# from ANL.                                                               #
+#                                                                         #
+# Additionally, redistribution and use in source and binary forms, with   #
+# or without modification, are permitted provided that the following      #
+# conditions are met:                                                     #
+#                                                                         #
+#     * Redistributions of source code must retain the above copyright    #
+#       notice, this list of conditions and the following disclaimer.     #
+#                                                                         #
+#     * Redistributions in binary form must reproduce the above copyright #
+#       notice, this list of conditions and the following disclaimer in   #
+#       the documentation and/or other materials provided with the        #
+#       distribution.                                                     #
+#                                                                         #
+#     * Neither the name of UChicago Argonne, LLC, Argonne National       #
+#       Laboratory, ANL, the U.S. Government, nor the names of its        #
+#       contributors may be used to endorse or promote products derived   #
+#       from this software without specific prior written permission.     #
+#                                                                         #
+# THIS SOFTWARE IS PROVIDED BY UChicago Argonne, LLC AND CONTRIBUTORS     #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT       #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS       #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL UChicago     #
+# Argonne, LLC OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,        #
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,    #
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;        #
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER        #
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT      #
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN       #
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE         #
+# POSSIBILITY OF SUCH DAMAGE.                                             #
+# #########################################################################
+
+'''
+    Pooled transports shared by the google slides client and the image uploads.
+    On a private network computer they route through the SOCKS5 tunnel
+    without patching the global socket.
+'''
+import socks
+import httplib2
+import requests
+import threading
+
+from requests.adapters import HTTPAdapter
+
+from tomolog_cli import log
+
+PROXY_HOST = '127.0.0.1'
+# Connections kept alive per host, also the number of uploads that can run concurrently
+POOL_SIZE = 8
+
+_sessions = {}
+_https = {}
+_lock = threading.Lock()
+
+
+def proxy_key(args):
+    # the local stand-ins are reached directly
+    return None if args.public or args.standin else (PROXY_HOST, args.port)
+
+
+def session(args):
+    '''requests.Session for the network setup of *args*, reusing keep-alive connections'''
+    key = proxy_key(args)
+    with _lock:
+        if key not in _sessions:
+            s = requests.Session()
+            adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+            s.mount('https://', adapter)
+            s.mount('http://', adapter)
+            if key is not None:
+                log.info('Routing uploads through the SOCKS5 proxy at %s:%s' % key)
+                # socks5h: host names are resolved on the far end of the tunnel
+                proxy_url = 'socks5h://%s:%s' % key
+                s.proxies = {'http': proxy_url, 'https': proxy_url}
+                # do not let *_PROXY environment variables bypass the tunnel
+                s.trust_env = False
+            _sessions[key] = s
+    return _sessions[key]
+
+
+def http(args):
+    '''httplib2.Http for the google API client of the network setup of *args*'''
+    key = proxy_key(args)
+    with _lock:
+        if key not in _https:
+            if key is not None:
+                log.info('Routing google API calls through the SOCKS5 proxy at %s:%s' % key)
+                proxy_info = httplib2.ProxyInfo(socks.PROXY_TYPE_SOCKS5, *key, proxy_rdns=True)
+                _https[key] = httplib2.Http(proxy_info=proxy_info)
+            else:
+                _https[key] = httplib2.Http()
+    return _https[key]
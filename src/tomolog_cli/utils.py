@@ -43,16 +43,27 @@
 # POSSIBILITY OF SUCH DAMAGE.                                             #
 # #########################################################################
 
+import io
 import os
+import mmap
+import errno
+import json
 import h5py
+import fcntl
 import datetime
 import tifffile
+import multiprocessing
 
 import numpy as np
 
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
 from collections import OrderedDict, deque
 from tomolog_cli import log
+from tomolog_cli import metrics
 
+@metrics.timed('find_min_max')
 def find_min_max(data,th=0.003):
     """Find min and max values according to histogram"""
 
@@ -118,11 +129,337 @@ def read_tiff_many(fname, z_start, z_end,idx, idy, nproc=8):
         proc.join()
     log.info(time.time()-t)
     
-def read_tiff_part(args, fname, x, y, z_start, z0_start, lchunk):
+def read_tiff_part(args, fname, x, y, z_start, z0_start, lchunk, nbytes=None):
     # print('!',z0_start,z_start)
+    total = 0
     for j in range(z0_start, z0_start + lchunk):
         # print(j)
         id = z_start + j
-        zz = read_tiff(f'{fname}_{id:05}.tiff')
-        y[j, :] = zz[args.idy]
-        x[j, :] = zz[:, args.idx]
\ No newline at end of file
+        x[j, :], y[j, :], size = read_tiff_lines(f'{fname}_{id:05}.tiff', args.idx, args.idy)
+        total += size
+    # bytes read, the reading threads are not timed as stages
+    if nbytes is not None:
+        nbytes.append(total)
+
+
+def read_tiff_lines(fname, idx, idy):
+    """
+    Read the column idx and the row idy of the tiff slice fname, and return them
+    with the bytes read. Uncompressed slices are memory mapped, tiled slices are
+    read by the tiles holding the column and the row, other slices are decoded whole.
+    """
+    with tifffile.TiffFile(fname) as tif:
+        page = tif.pages.first
+        h, w = page.shape[:2]
+        if page.is_memmappable:
+            image = np.memmap(fname, dtype=tif.byteorder + page.dtype.char, mode='r',
+                              offset=page.dataoffsets[0], shape=page.shape)
+            # the kernel reads one page per row for the column
+            row = w * image.dtype.itemsize
+            nbytes = min(h * min(row, mmap.PAGESIZE) + row, h * row)
+            return np.array(image[:, idx]), np.array(image[idy]), nbytes
+        if not page.is_tiled or page.samplesperpixel != 1 or page.imagedepth != 1:
+            image = page.asarray()
+            return image[:, idx], image[idy], sum(page.databytecounts)
+
+        tile_h, tile_w = page.tilelength, page.tilewidth
+        across = -(-w // tile_w)
+        tiles = set((idy // tile_h) * across + k for k in range(across))
+        tiles.update(k * across + idx // tile_w for k in range(-(-h // tile_h)))
+        tiles = sorted(tiles)
+        x = np.empty(h, dtype=page.dtype)
+        y = np.empty(w, dtype=page.dtype)
+        segments = tif.filehandle.read_segments([page.dataoffsets[k] for k in tiles],
+                                                [page.databytecounts[k] for k in tiles], indices=tiles)
+        for data, index in segments:
+            tile, (_, _, ty, tx, _), _ = page.decode(data, index, jpegtables=page.jpegtables)
+            tile = tile[0, :, :, 0]
+            if ty <= idy < ty + tile_h:
+                y[tx:tx + tile_w] = tile[idy - ty, :min(tile_w, w - tx)]
+            if tx <= idx < tx + tile_w:
+                x[ty:ty + tile_h] = tile[:min(tile_h, h - ty), idx - tx]
+        return x, y, sum(page.databytecounts[k] for k in tiles)
+
+
+# memory used by a streamed read of a volume, in bytes
+STREAM_BLOCK = 256 * 1024 * 1024
+
+# Processes reading large volumes, h5py reads one dataset at a time per process.
+# Smaller volumes are read in less time than the processes take to start
+_readers = None
+POOL_READ = 1024 * 1024 * 1024
+
+
+def _reader_pool(nproc):
+    global _readers
+    if _readers is None:
+        # spawned, not forked: the process runs threads (uploads, stand-ins)
+        _readers = ProcessPoolExecutor(max_workers=nproc, mp_context=multiprocessing.get_context('spawn'))
+    return _readers
+
+
+def _span(index, chunk, size):
+    """Extent of the chunk holding index along an axis"""
+    start = index // chunk * chunk
+    return min(start + chunk, size) - start
+
+
+def plan_orthoslices(data, idx, idy, idz):
+    """
+    Plan the reading of the x, y and z planes of the volume data. Return 'chunks'
+    to read the chunks intersecting the planes, or 'stream' to read the whole
+    volume once, in z blocks.
+    """
+    if data.chunks is None:
+        # contiguous: the x plane is a strided read of single values, one pass is cheaper
+        return 'stream'
+    # hdf5 reads whole chunks: each plane costs the chunks it intersects
+    h, w, w2 = data.shape
+    cz, cy, cx = data.chunks
+    planes = h * w * _span(idx, cx, w2) + h * _span(idy, cy, w) * w2 + _span(idz, cz, h) * w * w2
+    if planes < h * w * w2:
+        return 'chunks'
+    return 'stream'
+
+
+def read_orthoslices(data, idx, idy, idz, nproc=1):
+    """
+    Read the x, y and z planes of the volume data, an h5py dataset, through the
+    chunks intersecting them or in one streamed pass, see plan_orthoslices. Large
+    volumes are streamed by nproc processes, each reading its own z range.
+    Contiguous volumes are memory mapped instead.
+    """
+    volume = _memmap(data)
+    if volume is not None:
+        x, y, z, nbytes = _mapped_orthoslices(volume, idx, idy, idz)
+    elif nproc > 1 and data.nbytes > POOL_READ and plan_orthoslices(data, idx, idy, idz) == 'stream':
+        x, y, z, nbytes = _stream_parallel(data, idx, idy, idz, nproc)
+    else:
+        x, y, z, nbytes = _orthoslices(data, idx, idy, idz)
+    metrics.add('bytes_read', nbytes)
+    return x, y, z
+
+
+def _memmap(data):
+    # memory map of a contiguous, uncompressed dataset stored in its file, or None
+    if data.chunks is not None or data.is_virtual or data.id.get_create_plist().get_external_count() > 0:
+        return None
+    offset = data.id.get_offset()
+    if offset is None:
+        # not allocated, hdf5 returns fill values
+        return None
+    return np.memmap(data.file.filename, dtype=data.dtype, mode='r', offset=offset, shape=data.shape)
+
+
+def _mapped_orthoslices(volume, idx, idy, idz):
+    # The planes are gathered from the page cache, no z block is copied. The kernel
+    # reads one page per row of the x plane, with readahead
+    h, w, w2 = volume.shape
+    row = w2 * volume.dtype.itemsize
+    x = np.array(volume[:, :, idx])
+    y = np.array(volume[:, idy, :])
+    z = np.array(volume[idz])
+    nbytes = min(h * w * min(row, mmap.PAGESIZE) + (h + w) * row, volume.nbytes)
+    return x, y, z, nbytes
+
+
+def _orthoslices(data, idx, idy, idz):
+    # x, y and z planes and the bytes read. idz is None when the z plane is not needed
+    h, w, w2 = data.shape
+    itemsize = data.dtype.itemsize
+    z = None
+    if plan_orthoslices(data, idx, idy, 0 if idz is None else idz) == 'chunks':
+        log.info('Reading the chunks intersecting the slices')
+        cz, cy, cx = data.chunks
+        x = data[:, :, idx]
+        y = data[:, idy, :]
+        nbytes = h * w * _span(idx, cx, w2) + h * _span(idy, cy, w) * w2
+        if idz is not None:
+            z = data[idz]
+            nbytes += _span(idz, cz, h) * w * w2
+        return x, y, z, nbytes * itemsize
+
+    x = np.empty((h, w), dtype=data.dtype)
+    y = np.empty((h, w2), dtype=data.dtype)
+    if idz is not None:
+        z = np.empty((w, w2), dtype=data.dtype)
+    nbytes = _stream(data, 0, h, idx, idy, idz, x, y, z, STREAM_BLOCK)
+    return x, y, z, nbytes
+
+
+def _block_height(data, block):
+    # slices per read of at most block bytes, a multiple of the chunk height
+    h, w, w2 = data.shape
+    chunk_z = max(1, block // (w * w2 * data.dtype.itemsize))
+    if data.chunks is not None:
+        chunk_z = max(chunk_z // data.chunks[0], 1) * data.chunks[0]
+    return chunk_z
+
+
+def _stream(data, z_start, z_end, idx, idy, idz, x, y, z, block_size):
+    # Stream through z in bounded-memory blocks and extract all three planes
+    # in one pass. With z-primary chunks every chunk intersects the x and y
+    # planes, and slicing them separately rescans the whole file each time
+    chunk_z = _block_height(data, block_size)
+    nbytes = 0
+    for zs in range(z_start, z_end, chunk_z):
+        ze = min(zs + chunk_z, z_end)
+        block = data[zs:ze, :, :]
+        nbytes += block.nbytes
+        x[zs:ze] = block[:, :, idx]
+        y[zs:ze] = block[:, idy, :]
+        if z is not None and zs <= idz < ze:
+            z[:] = block[idz - zs]
+    return nbytes
+
+
+def _stream_part(fname, dset_name, z_start, z_end, idx, idy, idz, out, block_size, dtype):
+    # stream the slices z_start to z_end in a reader process, into the shared arrays out
+    shms = [shared_memory.SharedMemory(name=name) for name, shape in out]
+    planes = [np.ndarray(shape, dtype=dtype, buffer=shm.buf) for shm, (name, shape) in zip(shms, out)]
+    try:
+        with h5py.File(fname, 'r') as fid:
+            return _stream(fid[dset_name], z_start, z_end, idx, idy, idz, *planes, block_size)
+    finally:
+        # the arrays hold the shared buffers, release them before closing
+        del planes
+        for shm in shms:
+            shm.close()
+
+
+def _stream_parallel(data, idx, idy, idz, nproc):
+    # nproc processes stream z ranges of data, each with its own file handle, and
+    # write the planes in shared memory: only the ranges and byte counts are pickled
+    h, w, w2 = data.shape
+    log.info('Streaming the reconstruction with %d processes' % nproc)
+    shapes = [(h, w), (h, w2), (w, w2)]
+    shms = [shared_memory.SharedMemory(create=True, size=int(np.prod(shape)) * data.dtype.itemsize) for shape in shapes]
+    try:
+        out = [(shm.name, shape) for shm, shape in zip(shms, shapes)]
+        # z ranges aligned on the chunks, the memory of the blocks is shared by the processes
+        block = STREAM_BLOCK // nproc
+        step = -(-h // nproc)
+        if data.chunks is not None:
+            step = -(-step // data.chunks[0]) * data.chunks[0]
+        executor = _reader_pool(nproc)
+        futures = [executor.submit(_stream_part, data.file.filename, data.name, zs, min(zs + step, h),
+                                   idx, idy, idz, out, block, data.dtype) for zs in range(0, h, step)]
+        nbytes = sum(future.result() for future in futures)
+        x, y, z = [np.ndarray(shape, dtype=data.dtype, buffer=shm.buf).copy() for shm, shape in zip(shms, shapes)]
+    finally:
+        for shm in shms:
+            shm.close()
+            shm.unlink()
+    return x, y, z, nbytes
+
+
+def virtual_sources(fname, data):
+    """
+    Source datasets of the virtual dataset data of the file fname, as a sorted
+    list of (z start, z end, source file, source dataset). Return None when a
+    source is not a whole dataset mapped on whole z slices, as tomocupy writes them.
+    """
+    h, w, w2 = data.shape
+    sources = []
+    for source in data.virtual_sources():
+        start, end = source.vspace.get_select_bounds()
+        if start[1:] != (0, 0) or end[1:] != (w - 1, w2 - 1):
+            return None
+        if source.src_space.get_select_type() != h5py.h5s.SEL_ALL:
+            return None
+        path = source.file_name
+        if path == '.':
+            path = fname
+        elif not os.path.isabs(path):
+            # relative sources are found from the directory of the virtual dataset file
+            path = os.path.join(os.path.dirname(os.path.abspath(fname)), path)
+        sources.append((start[0], end[0] + 1, path, source.dset_name))
+    return sorted(sources)
+
+
+def _read_source(fname, dset_name, shape, idx, idy, idz):
+    with h5py.File(fname, 'r') as fid:
+        data = fid[dset_name]
+        if data.shape != shape:
+            raise ValueError('Virtual dataset source %s has shape %s, %s expected' % (fname, data.shape, shape))
+        return _orthoslices(data, idx, idy, idz)
+
+
+def read_virtual_orthoslices(fname, data, idx, idy, idz, nproc=8):
+    """
+    Read the x, y and z planes of the virtual dataset data of the file fname
+    directly from its source files, in nproc processes. Raise FileNotFoundError
+    when a source file is missing: hdf5 would silently return fill values.
+    """
+    sources = virtual_sources(fname, data)
+    if sources is None:
+        log.warning('Virtual dataset sources are not z ranges, reading through hdf5')
+        return read_orthoslices(data, idx, idy, idz)
+    h, w, w2 = data.shape
+    covered = 0
+    for z_start, z_end, path, dset_name in sources:
+        if z_start != covered:
+            raise ValueError('Virtual dataset of %s has no source for slices %d to %d' % (fname, covered, z_start))
+        if not os.path.exists(path):
+            raise FileNotFoundError(errno.ENOENT, 'Virtual dataset source missing', path)
+        covered = z_end
+    if covered != h:
+        raise ValueError('Virtual dataset of %s has no source for slices %d to %d' % (fname, covered, h))
+
+    log.info('Reading %d virtual dataset sources' % len(sources))
+    tasks = [(path, dset_name, (z_end - z_start, w, w2), idx, idy, idz - z_start if z_start <= idz < z_end else None)
+             for z_start, z_end, path, dset_name in sources]
+    if nproc > 1 and len(sources) > 1 and data.nbytes > POOL_READ:
+        executor = _reader_pool(nproc)
+        results = executor.map(_read_source, *zip(*tasks))
+    else:
+        results = (_read_source(*task) for task in tasks)
+    x = np.empty((h, w), dtype=data.dtype)
+    y = np.empty((h, w2), dtype=data.dtype)
+    z = None
+    for (z_start, z_end, path, dset_name), (xs, ys, zs, nbytes) in zip(sources, results):
+        x[z_start:z_end] = xs
+        y[z_start:z_end] = ys
+        if zs is not None:
+            z = zs
+        metrics.add('bytes_read', nbytes)
+    return x, y, z
+
+
+def image_buffer(name):
+    """In-memory file for a rendered image. *name* sets the file name and extension used by the upload"""
+    image = io.BytesIO()
+    image.name = name
+    return image
+
+
+@contextmanager
+def file_lock(fname):
+    """Hold an exclusive lock on *fname* so concurrent tomolog processes can share a file"""
+    with open(fname, 'a') as fid:
+        fcntl.flock(fid, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fid, fcntl.LOCK_UN)
+
+
+def read_json(fname, default=None):
+    """Read a json file, return *default* when it is missing or corrupted"""
+    try:
+        with open(fname, 'r') as fid:
+            return json.load(fid)
+    except (FileNotFoundError, ValueError):
+        return default
+
+
+def write_json(fname, data, mode=0o644):
+    """Write a json file atomically, readers never see a partially written file"""
+    tmp_fname = f'{fname}.{os.getpid()}.tmp'
+    # created with mode, tokens are never readable by others while written
+    fd = os.open(tmp_fname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    # a file left over by a crashed run keeps its permissions, set them again
+    os.fchmod(fd, mode)
+    with os.fdopen(fd, 'w') as fid:
+        json.dump(data, fid, indent=1)
+    os.replace(tmp_fname, fname)